@@ -0,0 +1,77 @@
+import time
+
+
+class AccessPolicy:
+    """Shared record of who may use the bot, used by every cog's checks.
+
+    Blacklisted users and moderators are held in sets, so each check is a constant-time lookup,
+    and both are updated in place as users are added or removed rather than re-read from storage.
+
+    Members with any of moderator_role_ids are moderators too, on top of the explicit list. Whether a member has one of
+    those roles is worked out from the member passed in, or else from the member cache (never fetched) through
+    member_lookup, and remembered for cache_ttl seconds or until the member is updated or leaves (see invalidate_member),
+    so checks stay a dict lookup.
+    """
+
+    owner_id = 305704400041803776  # LonelyPenguin
+
+    def __init__(self, blacklisted_users=(), moderator_ids=(), moderator_role_ids=(), member_lookup=None, cache_ttl: float = 300.0):
+        self.blacklisted_users = set(blacklisted_users)
+        self.moderator_ids = set(moderator_ids)
+        self.moderator_role_ids = set(moderator_role_ids)
+        self.member_lookup = member_lookup  # user ID -> cached discord.Member or None
+        self.cache_ttl = cache_ttl
+        self._role_moderators = {}  # user ID -> (has a moderator role, time the answer expires)
+
+    def is_owner(self, user_id: int):
+        return user_id == self.owner_id
+
+    def is_moderator(self, user_id: int, member=None):
+        """:param member: The user's discord.Member, if at hand (e.g. ctx.author in a guild), so their roles needn't be looked up."""
+        return user_id in self.moderator_ids or self._has_moderator_role(user_id, member)
+
+    def _has_moderator_role(self, user_id: int, member=None):
+        if not self.moderator_role_ids:
+            return False
+
+        cached = self._role_moderators.get(user_id)
+        now = time.monotonic()
+        if cached is not None and cached[1] > now:
+            return cached[0]
+
+        if getattr(member, 'roles', None) is None:  # a discord.User (e.g. in DMs) has no roles
+            member = self.member_lookup(user_id) if self.member_lookup is not None else None
+        if member is None:  # not in the guild (or not cached); nothing worth remembering
+            return False
+
+        has_role = any(role.id in self.moderator_role_ids for role in member.roles)
+        if len(self._role_moderators) >= 4096:
+            self._role_moderators = {cached_id: answer for cached_id, answer in self._role_moderators.items() if answer[1] > now}
+        self._role_moderators[user_id] = (has_role, now + self.cache_ttl)
+        return has_role
+
+    def invalidate_member(self, user_id: int):
+        """Forget whether a member has a moderator role, e.g. because their roles changed."""
+        self._role_moderators.pop(user_id, None)
+
+    def is_blacklisted(self, user_id: int):
+        return user_id in self.blacklisted_users
+
+    def may_use_bot(self, user_id: int):
+        """Blacklisted users are ignored, unless they are moderators or LonelyPenguin."""
+        return user_id not in self.blacklisted_users or self.is_moderator(user_id) or user_id == self.owner_id
+
+    def blacklist(self, user_id: int):
+        self.blacklisted_users.add(user_id)
+
+    def unblacklist(self, user_id: int):
+        self.blacklisted_users.discard(user_id)
+
+    def set_moderators(self, moderator_ids):
+        self.moderator_ids = set(moderator_ids)
+
+    def add_moderators(self, moderator_ids):
+        self.moderator_ids.update(moderator_ids)
+
+    def remove_moderators(self, moderator_ids):
+        self.moderator_ids.difference_update(moderator_ids)
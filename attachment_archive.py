@@ -0,0 +1,186 @@
+import asyncio
+import hashlib
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from sys import stderr
+from traceback import print_exception
+
+import aiohttp
+import discord
+from discord.ext import commands
+
+
+class AttachmentArchive:
+    """Local, content-addressed copy of every relayed attachment, so modmail logs don't depend on expiring CDN links.
+
+    Files are named after the SHA-256 hash of their contents (keeping the original extension), so an attachment that
+    is sent several times is only stored once. Archiving happens in background tasks and all disk access runs in a
+    worker thread, so neither the relay nor the event loop waits on it.
+    Once the archive grows past max_bytes, the files that were least recently stored are deleted.
+    """
+
+    def __init__(self, bot: commands.Bot, root: str = 'attachment_archive', max_bytes: int = 2 * 1024 ** 3, max_file_bytes: int = 100 * 1024 ** 2):
+        self.bot = bot
+        self.root = root
+        self.max_bytes = max_bytes
+        self.max_file_bytes = max_file_bytes
+
+        self._tasks = set()
+        self._lock = threading.Lock()
+        self._files = None  # archive name -> size, oldest first; loaded from disk on first use
+        self._total_bytes = 0
+        self._session = None
+
+    def schedule(self, modmailchnlid: int, message_id: int, attachment: discord.Attachment, data: bytes = None):
+        """Archive an attachment in the background.
+
+        :param modmailchnlid: Channel ID of the modmail the attachment was sent in.
+        :param message_id: ID of the message the attachment belongs to.
+        :param attachment: The attachment to archive.
+        :param data: The attachment's contents, if they were already downloaded. Otherwise, they are streamed from Discord.
+        """
+
+        task = asyncio.create_task(self.archive(modmailchnlid, message_id, attachment, data))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def archive(self, modmailchnlid: int, message_id: int, attachment: discord.Attachment, data: bytes = None):
+        """Store an attachment and record where it was archived. Errors are printed, never raised."""
+
+        try:
+            if attachment.size > self.max_file_bytes:
+                return
+
+            if data is not None:
+                archive_name = await asyncio.to_thread(self._store_bytes, data, attachment.filename)
+            else:
+                archive_name = await self._store_stream(attachment)
+
+            await self.bot.storage.add_archived_attachment(modmailchnlid, message_id, attachment.filename, archive_name)
+
+        except Exception as error:
+            print(f'Ignoring exception while archiving attachment {attachment.url}:', file=stderr)
+            print_exception(type(error), error, error.__traceback__, file=stderr)
+
+    async def archived_for_modmail(self, modmailchnlid: int):
+        """Return a dict of message ID -> list of (filename, archive path) for every attachment archived for a modmail."""
+
+        rows = await self.bot.storage.get_archived_attachments(modmailchnlid)
+
+        archived = {}
+        for message_id, filename, archive_name in rows:
+            archived.setdefault(message_id, []).append((filename, self.path(archive_name)))
+        return archived
+
+    async def forget_modmail(self, modmailchnlid: int):
+        """Drop a closed modmail's records. The archived files themselves are kept until they are evicted."""
+        await self.bot.storage.remove_archived_attachments(modmailchnlid)
+
+    async def warm_up(self):
+        """Scan the archive on disk now, rather than when the first attachment is archived. Run in the background at startup."""
+
+        def load_index():
+            with self._lock:
+                self._load_index()
+        await asyncio.to_thread(load_index)
+
+    def path(self, archive_name: str):
+        return os.path.join(self.root, archive_name[:2], archive_name)
+
+    async def close(self):
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        if self._session is not None:
+            await self._session.close()
+
+    # region blocking helpers, only ever called from a worker thread
+    def _load_index(self):
+        if self._files is not None:
+            return
+
+        found = []
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                stat = os.stat(os.path.join(dirpath, filename))
+                if filename.endswith('.part'):  # still being written, or left over from an interrupted download
+                    if stat.st_mtime < time.time() - 3600:
+                        os.remove(os.path.join(dirpath, filename))
+                    continue
+                found.append((stat.st_mtime, filename, stat.st_size))
+
+        self._files = OrderedDict((filename, size) for _, filename, size in sorted(found))
+        self._total_bytes = sum(self._files.values())
+
+    def _commit(self, temp_path: str, digest: str, filename: str, size: int):
+        """Move a fully written temporary file into place under its content hash, then evict old files if needed."""
+
+        archive_name = digest + os.path.splitext(filename)[1].lower()
+        final_path = self.path(archive_name)
+
+        with self._lock:
+            self._load_index()
+
+            if archive_name in self._files:  # duplicate: keep the stored copy, but mark it as recently used
+                os.remove(temp_path)
+                os.utime(final_path)
+                self._files.move_to_end(archive_name)
+            else:
+                os.makedirs(os.path.dirname(final_path), exist_ok=True)
+                os.replace(temp_path, final_path)
+                self._files[archive_name] = size
+                self._total_bytes += size
+
+            while self._total_bytes > self.max_bytes and len(self._files) > 1:
+                evicted_name, evicted_size = self._files.popitem(last=False)
+                self._total_bytes -= evicted_size
+                try:
+                    os.remove(self.path(evicted_name))
+                except FileNotFoundError:
+                    pass
+
+        return archive_name
+
+    def _new_temp_file(self):
+        os.makedirs(self.root, exist_ok=True)
+        return tempfile.mkstemp(suffix='.part', dir=self.root)
+
+    def _store_bytes(self, data: bytes, filename: str):
+        fd, temp_path = self._new_temp_file()
+        with os.fdopen(fd, 'wb') as temp_file:
+            temp_file.write(data)
+        return self._commit(temp_path, hashlib.sha256(data).hexdigest(), filename, len(data))
+
+    def _write_chunk(self, temp_file, digest, chunk: bytes):
+        temp_file.write(chunk)
+        digest.update(chunk)
+    # endregion
+
+    async def _store_stream(self, attachment: discord.Attachment):
+        """Stream an attachment from Discord to disk chunk by chunk, hashing it on the way."""
+
+        if self._session is None:
+            self._session = aiohttp.ClientSession()
+
+        fd, temp_path = await asyncio.to_thread(self._new_temp_file)
+        temp_file = os.fdopen(fd, 'wb')
+        digest = hashlib.sha256()
+        size = 0
+
+        try:
+            async with self._session.get(attachment.url) as response:
+                response.raise_for_status()
+                async for chunk in response.content.iter_chunked(1024 * 1024):
+                    size += len(chunk)
+                    if size > self.max_file_bytes:
+                        raise ValueError(f'attachment is larger than {self.max_file_bytes} bytes')
+                    await asyncio.to_thread(self._write_chunk, temp_file, digest, chunk)
+        except BaseException:
+            temp_file.close()
+            await asyncio.to_thread(os.remove, temp_path)
+            raise
+
+        temp_file.close()
+        return await asyncio.to_thread(self._commit, temp_path, digest.hexdigest(), attachment.filename, size)
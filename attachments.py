@@ -0,0 +1,91 @@
+import asyncio
+from contextlib import asynccontextmanager
+
+import discord
+
+
+# Discord's default upload limit, which also applies to DMs. Boosted guilds have higher limits (guild.filesize_limit).
+DEFAULT_UPLOAD_LIMIT = 8388608
+
+
+def upload_limit(destination):
+    """Return the maximum number of bytes that can be uploaded in one message to a channel or user."""
+
+    guild = getattr(destination, 'guild', None)
+    return guild.filesize_limit if guild is not None else DEFAULT_UPLOAD_LIMIT
+
+
+class ByteBudget:
+    """A number of bytes shared between relays, so the attachments they hold in memory stay within a fixed total.
+
+    A relay reserves the combined size of the attachments it is about to download, and keeps the reservation until
+    they have been sent on. A reservation larger than the whole budget is cut down to it, so such a relay still runs
+    (on its own) instead of waiting forever.
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.in_use = 0
+        self._released = asyncio.Condition()
+
+    @asynccontextmanager
+    async def reserve(self, nbytes: int):
+        nbytes = min(nbytes, self.capacity)
+        if nbytes <= 0:
+            yield
+            return
+
+        async with self._released:
+            await self._released.wait_for(lambda: self.in_use + nbytes <= self.capacity)
+            self.in_use += nbytes
+        try:
+            yield
+        finally:
+            async with self._released:
+                self.in_use -= nbytes
+                self._released.notify_all()
+
+
+@asynccontextmanager
+async def fetch_attachment_files(attachments: list, size_limit: int, download_slots: asyncio.Semaphore, byte_budget: ByteBudget):
+    """Download a message's attachments concurrently so that they can be re-uploaded elsewhere.
+
+    Attachment sizes are checked before anything is downloaded: attachments are taken in order for as long as their
+    combined size fits within size_limit, and the rest are returned separately so they can be linked instead.
+    Their size is reserved from byte_budget (shared between relays) before they are downloaded and until the
+    `async with` block ends, so send them on inside it; download_slots bounds how many downloads are in flight at once.
+
+    Used as `async with fetch_attachment_files(...) as (downloaded, too_large):`.
+
+    :param attachments: List of discord.Attachment objects to fetch.
+    :param size_limit: Upload limit of the destination, in bytes.
+    :param download_slots: Semaphore limiting the number of concurrent downloads.
+    :param byte_budget: ByteBudget bounding the attachment bytes held in memory by all relays together.
+    :return: Tuple of (list of (discord.Attachment, discord.File) pairs, list of discord.Attachment objects that were too large).
+    """
+
+    to_download = []
+    too_large = []
+    remaining_bytes = size_limit
+
+    for attachment in attachments:
+        if attachment.size <= remaining_bytes:
+            remaining_bytes -= attachment.size
+            to_download.append(attachment)
+        else:
+            too_large.append(attachment)
+
+    async def download(attachment: discord.Attachment):
+        async with download_slots:
+            return attachment, await attachment.to_file()
+
+    async with byte_budget.reserve(size_limit - remaining_bytes):
+        downloaded = await asyncio.gather(*[download(attachment) for attachment in to_download])
+        yield list(downloaded), too_large
+
+
+def too_large_embed(attachments: list):
+    """Embed linking to attachments that were too large to re-upload."""
+
+    links = '\n'.join(f'[{attachment.filename}]({attachment.url})' for attachment in attachments)
+    return discord.Embed(description=f'**Attachment(s) too large to relay, linked instead:**\n{links}')
@@ -0,0 +1,337 @@
+"""A small in-process stand-in for the parts of Discord the modmail cog talks to.
+
+Users, DM channels, text channels, a guild with a modmail category, messages, attachments and channel history are
+all simulated in memory. Every call that would be a REST request goes through FakeAPI, which adds a configurable
+latency and can answer with a 429 that is waited out and retried, like discord.py's HTTP client does.
+"""
+
+import asyncio
+import io
+import random
+import time
+from collections import Counter
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+import discord
+from discord.utils import time_snowflake
+
+from access_policy import AccessPolicy
+from attachment_archive import AttachmentArchive
+from metrics import Metrics
+from modmail_index import ActiveModmails
+from resolver import Resolver
+from transcripts import Transcripts
+
+
+class FakeAPI:
+    """Simulated Discord REST API: every request waits for latency (± jitter) seconds.
+
+    With probability rate_limit_chance, a request is answered with a 429 instead, and retried after retry_after seconds.
+    """
+
+    def __init__(self, latency: float = 0.05, jitter: float = 0.02, rate_limit_chance: float = 0.0, retry_after: float = 0.5, seed: int = 0):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit_chance = rate_limit_chance
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+
+        self.calls = Counter()  # route -> number of requests
+        self.rate_limited = Counter()  # route -> number of 429s
+        self._last_snowflake = 0
+
+    async def request(self, route: str):
+        while True:
+            self.calls[route] += 1
+            await asyncio.sleep(max(0.0, self.random.gauss(self.latency, self.jitter)))
+            if self.random.random() >= self.rate_limit_chance:
+                return
+            self.rate_limited[route] += 1
+            await asyncio.sleep(self.retry_after)
+
+    def snowflake(self):
+        """A new, unique snowflake ID for the current time."""
+
+        self._last_snowflake = max(time_snowflake(datetime.now(timezone.utc)), self._last_snowflake + 1)
+        return self._last_snowflake
+
+
+class FakeAttachment:
+    def __init__(self, api: FakeAPI, filename: str, data: bytes):
+        self.api = api
+        self.id = api.snowflake()
+        self.filename = filename
+        self.size = len(data)
+        self.url = f'https://cdn.example.invalid/attachments/{self.id}/{filename}'
+        self._data = data
+
+    async def read(self):
+        await self.api.request('GET cdn')
+        return self._data
+
+    async def to_file(self):
+        return discord.File(io.BytesIO(await self.read()), filename=self.filename)
+
+
+class FakeMessage:
+    def __init__(self, api: FakeAPI, channel, author, content: str = '', embeds: list = (), attachments: list = (), reply_to=None):
+        self.api = api
+        self.id = api.snowflake()
+        self.channel = channel
+        self.guild = getattr(channel, 'guild', None)
+        self.author = author
+        self.content = content
+        self.embeds = list(embeds)
+        self.attachments = list(attachments)
+        self.reference = SimpleNamespace(resolved=reply_to, message_id=reply_to.id) if reply_to is not None else None
+        self.created_at = datetime.now(timezone.utc)
+        self.reactions = []
+        self.pinned = False
+        # set when the bot marks the message as relayed, so the benchmark can time the relay
+        self.relayed = asyncio.Event()
+        self.relayed_at = None
+
+    @property
+    def system_content(self):
+        return self.content
+
+    @property
+    def jump_url(self):
+        return f'{self.channel.jump_url}/{self.id}'
+
+    async def add_reaction(self, emoji):
+        await self.api.request('PUT /channels/{channel_id}/messages/{message_id}/reactions/{emoji}/@me')
+        self.reactions.append(str(emoji))
+        if str(emoji) == '✅':
+            self.relayed_at = time.perf_counter()
+            self.relayed.set()
+
+    async def pin(self):
+        await self.api.request('PUT /channels/{channel_id}/pins/{message_id}')
+        self.pinned = True
+
+    async def edit(self, **kwargs):
+        await self.api.request('PATCH /channels/{channel_id}/messages/{message_id}')
+        if 'content' in kwargs:
+            self.content = kwargs['content']
+
+    async def delete(self, delay: float = None):
+        if delay:
+            await asyncio.sleep(delay)
+        await self.api.request('DELETE /channels/{channel_id}/messages/{message_id}')
+        self.channel.messages.remove(self)
+
+
+class FakeMessageable:
+    """Shared send/history behaviour of DM and text channels. Messages sent through send() are authored by the bot."""
+
+    def _init_messageable(self, api: FakeAPI, bot_user):
+        self.api = api
+        self.bot_user = bot_user
+        self.messages = []
+        self.uploaded_bytes = 0
+
+    async def send(self, content: str = None, *, embed=None, embeds=None, file=None, files=None, view=None, delete_after: float = None, **kwargs):
+        files = [file] if file is not None else list(files or [])
+        for each_file in files:
+            self.uploaded_bytes += len(each_file.fp.read())
+            each_file.close()
+
+        await self.api.request('POST /channels/{channel_id}/messages')
+        message = FakeMessage(self.api, self, self.bot_user, content or '', [embed] if embed is not None else embeds or [])
+        self.messages.append(message)
+        return message
+
+    def receive(self, author, content: str = '', attachments: list = (), reply_to=None):
+        """Simulate `author` sending a message here. Returns the message, to be dispatched to the bot."""
+
+        message = FakeMessage(self.api, self, author, content, attachments=attachments, reply_to=reply_to)
+        self.messages.append(message)
+        return message
+
+    async def history(self, limit: int = 100, before=None, oldest_first: bool = False):
+        await self.api.request('GET /channels/{channel_id}/messages')
+        messages = [message for message in self.messages if before is None or message.id < before.id]
+        messages = messages if oldest_first else messages[::-1]
+        for message in messages[:limit]:
+            yield message
+
+    def get_partial_message(self, message_id: int):
+        return SimpleNamespace(id=message_id, jump_url=f'{self.jump_url}/{message_id}')
+
+
+class FakeDMChannel(FakeMessageable):
+    def __init__(self, api: FakeAPI, bot_user, recipient):
+        self._init_messageable(api, bot_user)
+        self.id = api.snowflake()
+        self.recipient = recipient
+        self.guild = None
+
+    @property
+    def jump_url(self):
+        return f'https://discord.com/channels/@me/{self.id}'
+
+
+class FakeUser:
+    def __init__(self, api: FakeAPI, name: str, bot: bool = False):
+        self.api = api
+        self.id = api.snowflake()
+        self.name = name
+        self.discriminator = f'{self.id % 10000:04}'
+        self.bot = bot
+        self.dm_channel = None
+        self.bot_user = self if bot else None
+
+    @property
+    def mention(self):
+        return f'<@{self.id}>'
+
+    def __str__(self):
+        return f'{self.name}#{self.discriminator}'
+
+    async def create_dm(self):
+        if self.dm_channel is None:
+            await self.api.request('POST /users/@me/channels')
+            self.dm_channel = FakeDMChannel(self.api, self.bot_user, self)
+        return self.dm_channel
+
+    async def send(self, content: str = None, **kwargs):
+        return await (await self.create_dm()).send(content, **kwargs)
+
+    def history(self, **kwargs):
+        return self.dm_channel.history(**kwargs)
+
+
+class FakeTextChannel(FakeMessageable, discord.abc.GuildChannel):
+    def __init__(self, api: FakeAPI, bot_user, guild, name: str, category_id: int = None):
+        self._init_messageable(api, bot_user)
+        self.id = api.snowflake()
+        self.guild = guild
+        self.name = name
+        self.category_id = category_id
+
+    @property
+    def mention(self):
+        return f'<#{self.id}>'
+
+    @property
+    def jump_url(self):
+        return f'https://discord.com/channels/{self.guild.id}/{self.id}'
+
+    async def delete(self, reason: str = None):
+        await self.api.request('DELETE /channels/{channel_id}')
+        self.guild.channels.pop(self.id, None)
+
+
+class FakeCategory:
+    def __init__(self, api: FakeAPI, bot_user, guild, name: str):
+        self.api = api
+        self.bot_user = bot_user
+        self.id = api.snowflake()
+        self.guild = guild
+        self.name = name
+
+    @property
+    def channels(self):
+        return [channel for channel in self.guild.channels.values() if getattr(channel, 'category_id', None) == self.id]
+
+    text_channels = channels
+
+    async def create_text_channel(self, name: str, **kwargs):
+        await self.api.request('POST /guilds/{guild_id}/channels')
+        channel = FakeTextChannel(self.api, self.bot_user, self.guild, name, self.id)
+        self.guild.channels[channel.id] = channel
+        return channel
+
+
+class FakeGuild:
+    def __init__(self, api: FakeAPI, bot_user, filesize_limit: int = 8388608):
+        self.api = api
+        self.id = api.snowflake()
+        self.filesize_limit = filesize_limit
+        self.channels = {}
+
+        self.modmail_category = FakeCategory(api, bot_user, self, 'modmail')
+        self.channels[self.modmail_category.id] = self.modmail_category
+        self.logs_channel = FakeTextChannel(api, bot_user, self, 'modmail-logs')
+        self.channels[self.logs_channel.id] = self.logs_channel
+
+    def get_channel(self, channel_id: int):
+        return self.channels.get(channel_id)
+
+
+class FakeContext:
+    """Just enough of commands.Context to call a command's callback directly."""
+
+    def __init__(self, bot, message: FakeMessage):
+        self.bot = bot
+        self.message = message
+        self.author = message.author
+        self.channel = message.channel
+        self.guild = message.guild
+        self.command = None
+
+    async def send(self, content: str = None, **kwargs):
+        return await self.channel.send(content, **kwargs)
+
+
+class FakeBot:
+    """Stands in for the commands.Bot built in bot.py, with the same attributes, backed by a fake guild.
+
+    Storage, the modmail index, the access policy, transcripts, the attachment archive and metrics are the real ones,
+    so the benchmark measures the bot's own code; only Discord itself is simulated.
+    """
+
+    def __init__(self, api: FakeAPI, storage, metrics: Metrics, archive_dir: str, server_vars: dict = None):
+        self.api = api
+        self.user = FakeUser(api, 'Modmail', bot=True)
+        self.guild = FakeGuild(api, self.user)
+        self.users = {self.user.id: self.user}
+
+        self.server_vars = server_vars or {}
+        self.logs_channel_id = self.guild.logs_channel.id
+        self.server_id = self.guild.id
+        self.modmail_category_id = self.guild.modmail_category.id
+        self.latency = api.latency
+
+        self.simple_embed = lambda desc: discord.Embed(description = desc)
+        self.metrics = metrics
+        self.storage = storage
+        self.access_policy = AccessPolicy()
+        self.active_modmails = ActiveModmails(self)
+        self.attachment_archive = AttachmentArchive(self, root=archive_dir)
+        self.transcripts = Transcripts(self)
+        self.resolver = Resolver(self)
+
+    def add_user(self, name: str, moderator: bool = False):
+        user = FakeUser(self.api, name)
+        user.bot_user = self.user
+        self.users[user.id] = user
+        if moderator:
+            self.access_policy.set_moderators([*self.access_policy.moderator_ids, user.id])
+        return user
+
+    def get_user(self, user_id: int):
+        return self.users.get(user_id)
+
+    async def fetch_user(self, user_id: int):
+        await self.api.request('GET /users/{user.id}')
+        return self.users[user_id]
+
+    async def fetch_channel(self, channel_id: int):
+        await self.api.request('GET /channels/{channel.id}')
+        return self.get_channel(channel_id)
+
+    def get_channel(self, channel_id: int):
+        channel = self.guild.get_channel(channel_id)
+        if channel is None:
+            channel = next((user.dm_channel for user in self.users.values() if user.dm_channel and user.dm_channel.id == channel_id), None)
+        return channel
+
+    def get_guild(self, guild_id: int):
+        return self.guild if guild_id == self.guild.id else None
+
+    async def get_context(self, message: FakeMessage):
+        # the benchmark never sends commands as messages; they are invoked directly through FakeContext
+        return SimpleNamespace(command=None, message=message)
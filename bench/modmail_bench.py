@@ -0,0 +1,139 @@
+"""Load test for the modmail cog, run against the fake Discord in bench/fake_discord.py.
+
+Opens a number of modmails at once and, in each, relays messages back and forth (some with attachments, some replying
+to an earlier message), changes the reason halfway through and closes it. Reports relay throughput, relay latency
+(from a message being received to its ✅ reaction) and peak memory, so performance changes can be compared run to run.
+
+Run from the repository root:
+
+    python -m bench.modmail_bench --modmails 50 --messages 40 --latency 0.05 --rate-limit-chance 0.01
+"""
+
+import argparse
+import asyncio
+import os
+import resource
+import statistics
+import tempfile
+import time
+import tracemalloc
+
+from bench.fake_discord import FakeAPI, FakeAttachment, FakeBot, FakeContext
+from cogs.modmail import Modmail
+from metrics import Metrics
+from storage import ModmailStorage
+
+
+def percentile(sorted_values: list, q: float):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, round(q * (len(sorted_values) - 1)))]
+
+
+async def run_modmail(bot: FakeBot, cog: Modmail, moderators: list, number: int, options, relayed: list, failed: list):
+    """Open one modmail, relay options.messages messages through it, change its reason, and close it."""
+
+    user = bot.add_user(f'user{number}')
+    moderator = moderators[number % len(moderators)]
+    user_dm = await user.create_dm()
+
+    sent = []
+
+    first_message = user_dm.receive(user, f'Hello, this is modmail number {number}.')
+    sent.append((first_message, time.perf_counter()))
+    await cog.open_modmail_func(first_message, user.id, True)
+    modmail_channel = bot.get_channel(bot.active_modmails.by_user(user.id)[1])
+
+    for message_number in range(options.messages):
+        from_user = message_number % 2 == 0
+        channel, author = (user_dm, user) if from_user else (modmail_channel, moderator)
+
+        attachments = []
+        if options.attachment_every and message_number % options.attachment_every == options.attachment_every - 1:
+            attachments.append(FakeAttachment(bot.api, f'file{message_number}.png', os.urandom(options.attachment_bytes)))
+
+        reply_to = None
+        if options.reply_every and message_number % options.reply_every == options.reply_every - 1:
+            # reply to the newest message the bot relayed into this side of the conversation
+            reply_to = next((message for message in reversed(channel.messages) if message.author.id == bot.user.id), None)
+
+        message = channel.receive(author, f'Message {message_number} in modmail {number}. ' + 'x' * options.message_length, attachments, reply_to)
+        sent.append((message, time.perf_counter()))
+        await cog.modmail_dispatcher(message)
+
+        if message_number == options.messages // 2:
+            reason_ctx = FakeContext(bot, modmail_channel.receive(moderator, ';modmail reason benchmark'))
+            await cog.modmailreason.callback(cog, reason_ctx, reason=f'benchmark {number}')
+
+        if options.gap:
+            await asyncio.sleep(options.gap)
+
+    for message, received_at in sent:
+        try:
+            await asyncio.wait_for(message.relayed.wait(), timeout=options.timeout)
+            relayed.append(message.relayed_at - received_at)
+        except asyncio.TimeoutError:
+            failed.append(message)
+
+    close_ctx = FakeContext(bot, modmail_channel.receive(moderator, ';modmail close'))
+    await cog.closemodmail.callback(cog, close_ctx)
+
+
+async def run(options):
+    with tempfile.TemporaryDirectory() as workdir:
+        api = FakeAPI(latency=options.latency, jitter=options.jitter, rate_limit_chance=options.rate_limit_chance, retry_after=options.retry_after, seed=options.seed)
+
+        metrics = Metrics()
+
+        async with ModmailStorage(os.path.join(workdir, 'modmail.db'), metrics=metrics) as storage:
+            bot = FakeBot(api, storage, metrics, os.path.join(workdir, 'attachment_archive'), {'relay_coalesce_window': options.coalesce_window})
+            moderators = [bot.add_user(f'moderator{number}', moderator=True) for number in range(3)]
+
+            cog = Modmail(bot)
+            relayed, failed = [], []
+
+            tracemalloc.start()
+            started_at = time.perf_counter()
+            await asyncio.gather(*(run_modmail(bot, cog, moderators, number, options, relayed, failed) for number in range(options.modmails)))
+            elapsed = time.perf_counter() - started_at
+            _, peak_traced = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+            await cog.relay_queues.close()
+            await bot.attachment_archive.close()
+
+    relayed.sort()
+    print(f'{options.modmails} modmails x {options.messages + 1} messages, API latency {options.latency * 1000:.0f} ± {options.jitter * 1000:.0f} ms, '
+          f'429 chance {options.rate_limit_chance:.1%}, coalesce window {options.coalesce_window}s')
+    print(f'relayed:           {len(relayed)} messages in {elapsed:.2f}s ({len(relayed) / elapsed:.1f} msgs/s), {len(failed)} not relayed')
+    print(f'relay latency:     p50 {percentile(relayed, 0.5) * 1000:.1f} ms, p99 {percentile(relayed, 0.99) * 1000:.1f} ms, '
+          f'mean {statistics.fmean(relayed) * 1000 if relayed else 0:.1f} ms')
+    print(f'API requests:      {sum(api.calls.values())} ({sum(api.rate_limited.values())} rate limited)')
+    print(f'peak memory:       {peak_traced / 1024 ** 2:.1f} MiB traced, {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MiB max RSS')
+    if options.verbose:
+        for route, count in api.calls.most_common():
+            print(f'  {count:6}  {route}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--modmails', type=int, default=20, help='modmails open at once')
+    parser.add_argument('--messages', type=int, default=30, help='messages relayed per modmail, after the first')
+    parser.add_argument('--message-length', type=int, default=80, help='padding added to each message, in characters')
+    parser.add_argument('--gap', type=float, default=0.0, help='seconds between messages in one modmail')
+    parser.add_argument('--attachment-every', type=int, default=5, help='every Nth message has an attachment (0 for none)')
+    parser.add_argument('--attachment-bytes', type=int, default=256 * 1024, help='size of each attachment')
+    parser.add_argument('--reply-every', type=int, default=4, help='every Nth message is a reply (0 for none)')
+    parser.add_argument('--latency', type=float, default=0.05, help='mean simulated API latency, in seconds')
+    parser.add_argument('--jitter', type=float, default=0.02, help='standard deviation of the API latency, in seconds')
+    parser.add_argument('--rate-limit-chance', type=float, default=0.0, help='chance of any API request getting a 429')
+    parser.add_argument('--retry-after', type=float, default=0.5, help='seconds a 429 makes the request wait')
+    parser.add_argument('--coalesce-window', type=float, default=0, help='relay_coalesce_window setting to benchmark with')
+    parser.add_argument('--timeout', type=float, default=60.0, help='seconds to wait for a message to be relayed')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--verbose', '-v', action='store_true', help='also list API requests by route')
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,284 @@
+"""Replays exported modmail logs through the modmail cog, against the fake Discord in bench/fake_discord.py.
+
+Each log (in the format closemodmail writes, gzipped or not, split into parts or not) becomes one modmail. Its messages
+are replayed with their original timing, relative to the earliest message across all the logs, so a raid's burst of
+DMs arrives as a burst again; --speedup compresses the timeline. User and moderator messages go through the cog's
+on_message listener, reason changes through the reason command, and each modmail is closed once everything in it has
+been relayed. Prints per-stage timings, so an incident can be reproduced and measured offline.
+
+Run from the repository root:
+
+    python -m bench.replay logs/log-*.txt --speedup 10
+"""
+
+import argparse
+import asyncio
+import gzip
+import os
+import re
+import tempfile
+import time
+from datetime import datetime
+
+from bench.fake_discord import FakeAPI, FakeAttachment, FakeBot, FakeContext
+from bench.modmail_bench import percentile
+from cogs.modmail import Modmail
+from metrics import Metrics
+from storage import ModmailStorage
+from transcripts import parse_log
+
+
+MENTION = re.compile(r'<@!?(\d+)>')
+LEGACY_RELAY = re.compile(r'^\*\*(.+?)\*\*: (.*)$', re.DOTALL)
+REASON_CHANGE = re.compile(r'^(.+) set the modmail topic/reason to `(.*)`$', re.DOTALL)
+MOD_OPENED = re.compile(r"^Modmail opened by moderator <@!?(\d+)> to talk to user <@!?(\d+)>\. The reason for this modmail is `(.*?)`\..*?'s initial message\*\*:\n\n(.*)$", re.DOTALL)
+LOG_PART = re.compile(r'^(.*)-part(\d+)(\.txt)?(\.gz)?$')
+
+
+def read_logs(paths: list):
+    """Read log files, joining the parts of split logs back together. Returns {log name: entries}."""
+
+    grouped = {}
+    for path in paths:
+        part = LOG_PART.match(os.path.basename(path))
+        name, number = (part.group(1), int(part.group(2))) if part else (os.path.basename(path), 1)
+        grouped.setdefault(name, []).append((number, path))
+
+    logs = {}
+    for name, parts in grouped.items():
+        text = ''
+        for _, path in sorted(parts):
+            with (gzip.open(path, 'rt', encoding='utf-8') if path.endswith('.gz') else open(path, encoding='utf-8')) as log_file:
+                text += log_file.read()
+        logs[name] = parse_log(text)
+    return logs
+
+
+class ModmailScript:
+    """What happened in one logged modmail, as a list of timed events to replay.
+
+    Events are (time, kind, author ID, content, attachment URLs, ID of the replied-to entry, ID of the entry):
+    kind is 'open', 'user', 'moderator' or 'reason'.
+    """
+
+    def __init__(self, name: str, entries: list):
+        self.name = name
+        self.events = []
+        self.user_id = None
+        self.bot_id = None
+        self.from_user = True
+        self.reason = 'no reason specified'
+        self.names = {}  # author ID -> name, for the fake users
+
+        # the bot's opening notice is the first entry with embeds and no content; it names the user (and who opened it)
+        for entry in entries:
+            if entry.embeds and not entry.content:
+                self.bot_id = entry.authorid
+                mod_opened = MOD_OPENED.match(entry.embeds[0])
+                if mod_opened:
+                    self.from_user = False
+                    self.user_id = int(mod_opened.group(2))
+                    self.reason = mod_opened.group(3)
+                    self.events.append((self._time(entry), 'open', int(mod_opened.group(1)), mod_opened.group(4), [], None, entry.messageid))
+                else:
+                    mentions = MENTION.findall(entry.embeds[0])
+                    self.user_id = int(mentions[-1]) if mentions else None
+                break
+
+        opened = bool(self.events)
+        for entry in entries:
+            self.names.setdefault(entry.authorid, entry.authorname.rpartition('#')[0] or entry.authorname)
+            if entry.authorid == self.bot_id:
+                legacy_relay = LEGACY_RELAY.match(entry.content)
+                reason_change = REASON_CHANGE.match(entry.embeds[0]) if entry.embeds and not entry.content else None
+                if legacy_relay:  # logs read from channel history only have the bot's copy of the user's messages
+                    event = (self._time(entry), 'user', self.user_id, legacy_relay.group(2), entry.attachments, entry.replyto, entry.messageid)
+                elif reason_change:
+                    self.events.append((self._time(entry), 'reason', reason_change.group(1), reason_change.group(2), [], None, entry.messageid))
+                    continue
+                else:  # other notices are sent by the bot itself
+                    continue
+            elif entry.authorid == self.user_id or self.user_id is None:
+                self.user_id = entry.authorid
+                event = (self._time(entry), 'user', entry.authorid, entry.content, entry.attachments, entry.replyto, entry.messageid)
+            else:
+                event = (self._time(entry), 'moderator', entry.authorid, entry.content, entry.attachments, entry.replyto, entry.messageid)
+
+            if not opened:  # the first message opens the modmail
+                self.from_user = event[1] == 'user'
+                event = (event[0], 'open', *event[2:])
+                opened = True
+            self.events.append(event)
+
+    @staticmethod
+    def _time(entry):
+        return datetime.fromisoformat(entry.createdat)
+
+    @property
+    def started_at(self):
+        return self.events[0][0]
+
+
+class Replayer:
+    def __init__(self, bot: FakeBot, cog: Modmail, options):
+        self.bot = bot
+        self.cog = cog
+        self.options = options
+        self.stages = {'open': [], 'relay to moderators': [], 'relay to user': [], 'reason': [], 'close': []}
+        self.schedule_lag = []  # how late each event was started, compared to its replayed time
+        self.not_relayed = 0
+        self.failures = []
+        self.users = {}  # author ID in the logs -> fake user
+
+    def fake_user(self, log_author_id: int, name: str, moderator: bool = False):
+        if log_author_id not in self.users:
+            self.users[log_author_id] = self.bot.add_user(name, moderator=moderator)
+        return self.users[log_author_id]
+
+    async def replay(self, script: ModmailScript, t0: datetime, replay_started_at: float):
+        user = self.fake_user(script.user_id, script.names.get(script.user_id, 'user'))
+        user_dm = await user.create_dm()
+        staff_channel = self.bot.guild.logs_channel  # where a moderator runs ;modmail open
+        modmail_channel = None
+        replayed = {}  # log message ID -> (replayed message, whether it was sent on the user's side)
+        sent = []
+
+        for at, kind, author_id, content, attachment_urls, replyto, log_id in script.events:
+            due = replay_started_at + (at - t0).total_seconds() / self.options.speedup
+            await asyncio.sleep(max(0.0, due - time.perf_counter()))
+            self.schedule_lag.append(time.perf_counter() - due)
+
+            if kind == 'reason':  # the notice only names the moderator
+                moderator_id = next((each_id for each_id, name in script.names.items() if name == author_id.rpartition('#')[0]), None)
+                moderator = self.fake_user(moderator_id, script.names.get(moderator_id, 'moderator'), moderator=True)
+                started_at = time.perf_counter()
+                await self.cog.modmailreason.callback(self.cog, FakeContext(self.bot, modmail_channel.receive(moderator, ';modmail reason')), reason=content)
+                self.stages['reason'].append(time.perf_counter() - started_at)
+                continue
+
+            on_user_side = author_id == script.user_id
+            author = user if on_user_side else self.fake_user(author_id, script.names.get(author_id, 'moderator'), moderator=True)
+            attachments = [FakeAttachment(self.bot.api, url.rpartition('/')[2] or 'attachment', os.urandom(self.options.attachment_bytes)) for url in attachment_urls]
+
+            if kind == 'open':
+                channel = user_dm if script.from_user else staff_channel
+                message = channel.receive(author, content, attachments)
+                started_at = time.perf_counter()
+                await self.cog.open_modmail_func(message, user.id, script.from_user, modmailreason=script.reason)
+                self.stages['open'].append(time.perf_counter() - started_at)
+                modmail_channel = self.bot.get_channel(self.bot.active_modmails.by_user(user.id)[1])
+                replayed[log_id] = (message, on_user_side)
+                continue
+
+            channel = user_dm if on_user_side else modmail_channel
+            reply_to = None
+            if replyto in replayed:
+                original, original_on_user_side = replayed[replyto]
+                if original_on_user_side == on_user_side:
+                    reply_to = original
+                else:  # the sender sees the bot's relayed copy of it
+                    counterpart_id = await self.bot.storage.get_relayed_counterpart(original.id)
+                    reply_to = next((each for each in channel.messages if each.id == counterpart_id), None)
+
+            message = channel.receive(author, content, attachments, reply_to)
+            replayed[log_id] = (message, on_user_side)
+            sent.append((message, time.perf_counter(), 'relay to moderators' if on_user_side else 'relay to user'))
+            await self.cog.modmail_dispatcher(message)
+
+        for message, received_at, stage in sent:
+            try:
+                await asyncio.wait_for(message.relayed.wait(), timeout=self.options.timeout)
+                self.stages[stage].append(message.relayed_at - received_at)
+            except asyncio.TimeoutError:
+                self.not_relayed += 1
+
+        if modmail_channel is not None:
+            started_at = time.perf_counter()
+            await self.cog.closemodmail.callback(self.cog, FakeContext(self.bot, modmail_channel.receive(self.fake_user(None, 'moderator', moderator=True), ';modmail close')))
+            self.stages['close'].append(time.perf_counter() - started_at)
+
+    async def replay_safely(self, script: ModmailScript, t0: datetime, replay_started_at: float):
+        try:
+            await self.replay(script, t0, replay_started_at)
+        except Exception as error:
+            self.failures.append((script.name, error))
+
+
+def timing_line(name: str, samples: list):
+    if not samples:
+        return f'{name:<28} -'
+    samples = sorted(samples)
+    return (f'{name:<28} {len(samples):6}  p50 {percentile(samples, 0.5) * 1000:9.1f} ms  p99 {percentile(samples, 0.99) * 1000:9.1f} ms'
+            f'  max {samples[-1] * 1000:9.1f} ms')
+
+
+def histogram_line(name: str, histogram, **labels):
+    if histogram is None or not histogram.count(**labels):
+        return f'{name:<28} -'
+    return (f'{name:<28} {histogram.count(**labels):6}  p50 {histogram.quantile(0.5, **labels) * 1000:9.1f} ms  p99 {histogram.quantile(0.99, **labels) * 1000:9.1f} ms'
+            f'  mean {histogram.mean(**labels) * 1000:8.1f} ms')
+
+
+async def run(options):
+    scripts = [ModmailScript(name, entries) for name, entries in read_logs(options.logs).items()]
+    scripts = [script for script in scripts if script.events]
+    if not scripts:
+        print('No messages found in the given logs.')
+        return
+
+    t0 = min(script.started_at for script in scripts)
+    original_duration = (max(script.events[-1][0] for script in scripts) - t0).total_seconds()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        api = FakeAPI(latency=options.latency, jitter=options.jitter, rate_limit_chance=options.rate_limit_chance, retry_after=options.retry_after, seed=options.seed)
+        metrics = Metrics()
+
+        async with ModmailStorage(os.path.join(workdir, 'modmail.db'), metrics=metrics) as storage:
+            bot = FakeBot(api, storage, metrics, os.path.join(workdir, 'attachment_archive'), {'relay_coalesce_window': options.coalesce_window})
+            cog = Modmail(bot)
+            replayer = Replayer(bot, cog, options)
+
+            started_at = time.perf_counter()
+            await asyncio.gather(*(replayer.replay_safely(script, t0, started_at) for script in scripts))
+            elapsed = time.perf_counter() - started_at
+
+            await cog.relay_queues.close()
+            await bot.attachment_archive.close()
+
+    print(f'Replayed {len(scripts)} modmails ({sum(len(script.events) for script in scripts)} events) spanning {original_duration:.0f}s '
+          f'at {options.speedup}x in {elapsed:.2f}s; {replayer.not_relayed} messages not relayed, {len(replayer.failures)} modmails failed')
+    print()
+    print('Stages, as seen from outside the bot:')
+    for stage, samples in replayer.stages.items():
+        print(timing_line(stage, samples))
+    print(timing_line('behind schedule', replayer.schedule_lag))
+    print()
+    print("Inside the bot (from its metrics):")
+    print(histogram_line('DM listener', metrics.get('modmail_listener_seconds'), listener='dm_modmail_listener'))
+    print(histogram_line('modmail channel listener', metrics.get('modmail_listener_seconds'), listener='guild_modmail_listener'))
+    print(histogram_line('relay_message', metrics.get('modmail_relay_seconds')))
+    print(histogram_line('database queries', metrics.get('db_query_seconds')))
+    print(histogram_line('database commits', metrics.get('db_commit_seconds')))
+    print()
+    print(f'API requests: {sum(api.calls.values())} ({sum(api.rate_limited.values())} rate limited)')
+    for name, error in replayer.failures:
+        print(f'{name}: {error!r}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('logs', nargs='+', help='modmail log files (.txt or .txt.gz; split logs are joined back together)')
+    parser.add_argument('--speedup', type=float, default=1.0, help='replay this many times faster than the original')
+    parser.add_argument('--attachment-bytes', type=int, default=256 * 1024, help='size of each replayed attachment (logs only have URLs)')
+    parser.add_argument('--latency', type=float, default=0.05, help='mean simulated API latency, in seconds')
+    parser.add_argument('--jitter', type=float, default=0.02, help='standard deviation of the API latency, in seconds')
+    parser.add_argument('--rate-limit-chance', type=float, default=0.0, help='chance of any API request getting a 429')
+    parser.add_argument('--retry-after', type=float, default=0.5, help='seconds a 429 makes the request wait')
+    parser.add_argument('--coalesce-window', type=float, default=0, help='relay_coalesce_window setting to replay with')
+    parser.add_argument('--timeout', type=float, default=60.0, help='seconds to wait for a message to be relayed')
+    parser.add_argument('--seed', type=int, default=0)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
@@ -2,72 +2,156 @@ import asyncio
 import json
 import logging
 
-import aiosqlite
 import discord
 from discord.ext import commands
 
+from access_policy import AccessPolicy
+from attachment_archive import AttachmentArchive
 from config.private import token
+from logging_setup import setup_logging
+from loop_watchdog import LoopWatchdog
+from metrics import Metrics, instrument_http
+from modmail_index import ActiveModmails
+from moderator_registry import ModeratorRegistry
+from resolver import Resolver
+from startup_timer import StartupTimer
+from storage import ModmailStorage
+from transcripts import Transcripts
 
 
-logger = logging.getLogger("discord")
-logger.setLevel(logging.DEBUG)
-handler = logging.FileHandler(
-    filename="discord.log", encoding="utf-8", mode="w")
-handler.setFormatter(logging.Formatter(
-    "%(asctime)s:%(levelname)s:%(name)s: %(message)s"))
-logger.addHandler(handler)
+async def report_startup(bot: commands.Bot, timer: StartupTimer):
+    """Log how long each phase of startup took, once the bot has connected to the gateway and is ready."""
 
+    with timer.phase('gateway (connect until ready)'):
+        await bot.wait_until_ready()
 
-async def startup():
-
-    intents = discord.Intents(guilds=True, members=True, emojis=True, messages=True, reactions=True)
-
-    myactivity = discord.Activity(
-        name='DMs from you', type=discord.ActivityType.listening)
-
-    bot = commands.Bot(
-        command_prefix=commands.when_mentioned_or(';'),
-        intents=intents, activity=myactivity,
-        help_command=commands.MinimalHelpCommand()
-        )
+    bot.metrics.gauge('startup_seconds', 'Time taken from starting the bot until it was connected and ready.').set(timer.elapsed())
+    report = timer.report()
+    logging.getLogger('discord').info('Startup took %.2fs:\n%s', timer.elapsed(), report)
+    print(f'\nReady. Startup took {timer.elapsed():.2f}s:\n{report}')
 
-    bot.simple_embed = lambda desc: discord.Embed(description = desc)
 
-    async with aiosqlite.connect('modmail.db') as conn:
-
-        bot.conn = conn
-        c = await conn.cursor()
-        await c.execute('CREATE TABLE IF NOT EXISTS activemodmails (userid integer, modmailchnlid integer, reason text)')
-        await c.execute('CREATE TABLE IF NOT EXISTS blacklist (timestamp text, userid integer, username text)')
-        await bot.conn.commit()
-        await c.execute('SELECT * FROM blacklist')
-        bot.blacklisted_users = [each_row[1] for each_row in await c.fetchall()]
-
-        async def do_db_query(bot: commands.Bot, query: str, args: tuple, fetch = None):
-            async with bot.conn.execute(query, args) as c:
-                if fetch == "one":
-                    return await c.fetchone()
-                elif fetch == "all":
-                    return await c.fetchall()
-                else:
-                    await bot.conn.commit()
-                    return None
+async def startup():
 
-        bot.do_db_query = do_db_query
+    # each phase is timed, and the report is logged once the bot is ready (see report_startup)
+    timer = StartupTimer()
 
+    with timer.phase('config'):
         with open("config/server_vars.json") as server_vars_file:
             server_vars = json.load(server_vars_file)
-        bot.logs_channel_id, bot.server_id, bot.modmail_category_id, bot.moderator_ids = list(server_vars.values())
-        print(f'{bot.logs_channel_id = }, {bot.server_id = }, {bot.modmail_category_id = }, {bot.moderator_ids = }')
-
-        all_extensions = ['cogs.modmail', 'cogs.dev_cmds', 'cogs.slash_cmds', 'cogs.misc', 'cogs.blacklist', 'cogs.admin']
 
-        for extension in all_extensions:
-            bot.load_extension(extension)
-            print(f'\nLoaded extension {extension}')
+        # rotated every log_max_bytes or log_max_age_hours, whichever comes first; the level can be changed with ;admin loglevel
+        log_listener = setup_logging(
+            'discord.log', level=server_vars.get('log_level', 'INFO'), max_bytes=server_vars.get('log_max_bytes', 10 * 1024 ** 2),
+            max_age=server_vars.get('log_max_age_hours', 24) * 60 * 60, backup_count=server_vars.get('log_backup_count', 5))
+
+    with timer.phase('client'):
+        # low_memory_mode drops the member list: no members intent, no chunking at startup and no member cache. Users are
+        # then fetched when needed (see Resolver), and moderator roles are only seen on members who message the bot
+        low_memory = server_vars.get('low_memory_mode', False)
+        if low_memory:
+            intents = discord.Intents(guilds=True, messages=True, reactions=True)
+            member_cache_flags = discord.MemberCacheFlags.none()
+        else:
+            intents = discord.Intents(guilds=True, members=True, emojis=True, messages=True, reactions=True)
+            member_cache_flags = discord.MemberCacheFlags.from_intents(intents)
+
+        myactivity = discord.Activity(
+            name='DMs from you', type=discord.ActivityType.listening)
+
+        bot = commands.Bot(
+            command_prefix=commands.when_mentioned_or(';'),
+            intents=intents, activity=myactivity,
+            member_cache_flags=member_cache_flags, chunk_guilds_at_startup=not low_memory,
+            help_command=commands.MinimalHelpCommand()
+            )
+
+        bot.simple_embed = lambda desc: discord.Embed(description = desc)
+
+        bot.metrics = Metrics()
+        instrument_http(bot.http, bot.metrics)
+        bot.resolver = Resolver(bot, max_size=server_vars.get('resolver_max_size', 256), ttl=server_vars.get('resolver_ttl', 600))
+
+        # the first four keys are required, any after them are optional settings read with .get()
+        bot.server_vars = server_vars
+        bot.logs_channel_id, bot.server_id, bot.modmail_category_id, moderator_ids = list(server_vars.values())[:4]
+        print(f'{bot.logs_channel_id = }, {bot.server_id = }, {bot.modmail_category_id = }, {moderator_ids = }, {low_memory = }')
+
+    # logging in only needs the token, so it happens over REST while the database is opened and read
+    login = asyncio.create_task(timer.timed('login', bot.login(token)))
+
+    storage = ModmailStorage('modmail.db', read_connections=server_vars.get('db_read_connections', 3), metrics=bot.metrics)
+
+    try:
+        with timer.phase('database'):
+            await storage.open()
+        bot.storage = storage
+
+        # members with any of moderator_role_ids are moderators as well as those in the registry; roles are read from the member cache only
+        bot.access_policy = AccessPolicy(
+            moderator_role_ids=server_vars.get('moderator_role_ids', []),
+            member_lookup=lambda user_id: bot.get_guild(bot.server_id) and bot.get_guild(bot.server_id).get_member(user_id),
+            cache_ttl=server_vars.get('moderator_cache_ttl', 300))
+        bot.moderator_registry = ModeratorRegistry(bot)
+        bot.active_modmails = ActiveModmails(bot)
+
+        async def load_blacklist():
+            for each_row in await storage.get_blacklist():
+                bot.access_policy.blacklist(each_row[1])
+
+        # independent of each other, so they are read at once, over the storage's read connections
+        with timer.phase('state'):
+            await asyncio.gather(
+                timer.timed('state: blacklist', load_blacklist()),
+                # moderator_ids in server_vars.json only seeds the moderators table when it is created; after that, the table is the only record
+                timer.timed('state: moderators', bot.moderator_registry.load(seed_ids=moderator_ids if 3 in storage.applied_migrations else ())),
+                timer.timed('state: modmail index', bot.active_modmails.load()))
+        bot.metrics.gauge('modmail_active_modmails', 'Modmails currently open.', lambda: len(bot.active_modmails))
+
+        bot.attachment_archive = AttachmentArchive(
+            bot, root=server_vars.get('attachment_archive_dir', 'attachment_archive'),
+            max_bytes=server_vars.get('attachment_archive_max_bytes', 2 * 1024 ** 3))
+        bot.transcripts = Transcripts(bot)
+
+        all_extensions = ['cogs.modmail', 'cogs.dev_cmds', 'cogs.slash_cmds', 'cogs.misc', 'cogs.blacklist', 'cogs.admin', 'cogs.maintenance']
+
+        # load_extension is synchronous in this version of discord.py, so extensions can't be loaded concurrently;
+        # each is timed so a slow one stands out in the report
+        with timer.phase('extensions'):
+            for extension in all_extensions:
+                with timer.phase(f'extension: {extension}'):
+                    bot.load_extension(extension)
+                print(f'\nLoaded extension {extension}')
+
+        bot.loop_watchdog = LoopWatchdog(bot, threshold=server_vars.get('loop_stall_threshold', 0.5))
+        bot.loop_watchdog.start()
+
+        # set metrics_port to null in server_vars.json to turn the endpoint off
+        metrics_port = server_vars.get('metrics_port', 9108)
+        if metrics_port is not None:
+            with timer.phase('metrics endpoint'):
+                await bot.metrics.serve(port=metrics_port)
+
+        # nothing needs the attachment archive's index until the first attachment is archived, so it is scanned while connecting
+        background_tasks = [
+            asyncio.create_task(timer.timed('attachment archive scan', bot.attachment_archive.warm_up())),
+            asyncio.create_task(report_startup(bot, timer))]
 
         print(f'\nStarting bot up \n----')
 
-        await bot.start(token)
+        try:
+            await login
+            await bot.connect()
+        finally:
+            bot.loop_watchdog.stop()
+            await bot.metrics.close()
+            for task in background_tasks:
+                task.cancel()
+            # archiving still in progress writes to the database, so it has to finish before the storage is closed
+            await bot.attachment_archive.close()
+    finally:
+        login.cancel()
+        await storage.close()
+        log_listener.stop()
 
 asyncio.run(startup())
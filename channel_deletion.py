@@ -0,0 +1,94 @@
+import asyncio
+import time
+from sys import stderr
+from traceback import print_exception
+
+import discord
+
+
+class DeletionSummary:
+    """The outcome of a bulk channel deletion."""
+
+    def __init__(self, total: int):
+        self.total = total
+        self.deleted = []
+        self.already_gone = []  # channels (or IDs) that didn't exist anymore
+        self.unknown = []  # IDs that weren't cached and couldn't be looked up, so may or may not still exist
+        self.failed = []  # (channel, error) pairs
+        self.elapsed = 0.0
+
+    @property
+    def done(self):
+        return len(self.deleted) + len(self.already_gone) + len(self.unknown) + len(self.failed)
+
+    def __str__(self):
+        summary = f'Deleted {len(self.deleted)} of {self.total} channels in {self.elapsed:.1f}s.'
+        if self.already_gone:
+            summary += f' {len(self.already_gone)} had already been deleted.'
+        if self.unknown:
+            summary += f" {len(self.unknown)} couldn't be looked up, so weren't touched: " + ', '.join(str(channel_id) for channel_id in self.unknown)
+        if self.failed:
+            summary += f' {len(self.failed)} could not be deleted:\n' + '\n'.join(f'{getattr(channel, "id", channel)}: {error}' for channel, error in self.failed)
+        return summary
+
+
+async def delete_channels(channels, reason: str = None, max_concurrent: int = 5, progress=None, fetch_channel=None):
+    """Delete many channels as fast as Discord's rate limits allow.
+
+    discord.py's HTTP client already reads the rate limit headers of every response: it waits out a bucket once it has
+    no requests remaining and retries after a 429. So rather than sleeping a fixed time between deletions, this just
+    keeps a few deletions in flight and lets the client pace them.
+
+    :param channels: The channels to delete, or the IDs of channels that aren't cached.
+    :param reason: Shows up in the audit log.
+    :param max_concurrent: How many deletions to have in flight at once.
+    :param progress: Optional coroutine function, awaited as `progress(summary)` after each channel is dealt with.
+        An exception it raises is printed and otherwise ignored, so it can't cut the deletion short.
+    :param fetch_channel: Coroutine function (e.g. bot.fetch_channel) used to look up IDs. IDs it reports as not found
+        are counted as already deleted; without it, or if the lookup fails otherwise, they are counted as unknown.
+    :return: DeletionSummary
+    """
+
+    channels = list(channels)
+    summary = DeletionSummary(len(channels))
+    slots = asyncio.Semaphore(max_concurrent)
+    started_at = time.perf_counter()
+
+    async def delete_one(channel):
+        async with slots:
+            if isinstance(channel, int):
+                channel = await look_up(channel)
+            if channel is not None:
+                try:
+                    await channel.delete(reason=reason)
+                    summary.deleted.append(channel)
+                except discord.NotFound:
+                    summary.already_gone.append(channel)
+                except discord.HTTPException as error:
+                    summary.failed.append((channel, error))
+
+            summary.elapsed = time.perf_counter() - started_at
+            if progress is not None:
+                try:
+                    await progress(summary)
+                except Exception as error:
+                    print('Ignoring exception in channel deletion progress callback:', file=stderr)
+                    print_exception(type(error), error, error.__traceback__, file=stderr)
+
+    async def look_up(channel_id: int):
+        """Return the channel with this ID, or None after recording it as already gone or unknown."""
+
+        if fetch_channel is None:
+            summary.unknown.append(channel_id)
+            return None
+        try:
+            return await fetch_channel(channel_id)
+        except discord.NotFound:
+            summary.already_gone.append(channel_id)
+        except discord.HTTPException:
+            summary.unknown.append(channel_id)
+        return None
+
+    await asyncio.gather(*(delete_one(channel) for channel in channels))
+    summary.elapsed = time.perf_counter() - started_at
+    return summary
@@ -1,4 +1,4 @@
-import json
+import logging
 from sys import stderr
 from traceback import print_exception
 
@@ -15,13 +15,13 @@ class Admin(commands.Cog):
     def cog_check(self, ctx: commands.Context):
 
        # Ignore blacklisted users unless they are mods or LonelyPenguin
-        return ctx.author.id not in self.bot.blacklisted_users or ctx.author.id in self.bot.moderator_ids or ctx.author.id == 305704400041803776
+        return self.bot.access_policy.may_use_bot(ctx.author.id)
 
     def mod_only():
         """Commands with this check will only execute for moderators."""
 
         def predicate(ctx: commands.Context):
-            return ctx.author.id in ctx.bot.moderator_ids
+            return ctx.bot.access_policy.is_moderator(ctx.author.id, ctx.author)
         return commands.check(predicate)
 
 # region admin commands and errors
@@ -36,66 +36,94 @@ class Admin(commands.Cog):
     async def manual_modmail_add(self, ctx: commands.Context, modmail_user: discord.Member, modmail_channel: discord.TextChannel, *, modmail_reason: str = 'no reason specified'):
         """Re-registers a modmail that already exists on the server, but which the bot has forgotten about for whatever reason."""
 
-        modmail_entry = await self.bot.do_db_query(self.bot, 'SELECT * FROM activemodmails WHERE userid=?', (modmail_user.id,), "one")
+        modmail_entry = self.bot.active_modmails.by_user(modmail_user.id)
 
         if modmail_entry is not None:
             await ctx.send(embed=self.bot.simple_embed(f'Error: There is already a known modmail attached to that user: <#{modmail_entry[1]}>.'))
             return
 
-        await self.bot.do_db_query(self.bot, 'INSERT INTO activemodmails VALUES (?,?,?)', (modmail_user.id, modmail_channel.id, modmail_reason))
+        modmail_entry = self.bot.active_modmails.by_channel(modmail_channel.id)
+
+        if modmail_entry is not None:
+            await ctx.send(embed=self.bot.simple_embed(f'Error: That channel is already registered as the modmail of <@{modmail_entry[0]}>.'))
+            return
+
+        await self.bot.active_modmails.add(modmail_user.id, modmail_channel.id, modmail_reason)
 
         await ctx.send(embed=self.bot.simple_embed(f'Successfully re-registered a modmail: {modmail_user.mention} in the channel {modmail_channel.mention}.'))
 
     @admin.command(name='addmoderator', aliases=['addmod', 'moderatoradd', 'newmod', 'modadd', 'modnew', 'addmoderators'])
     async def add_moderators(self, ctx: commands.Context, *, new_moderators: str):
-        """Add users to the bot's list of moderators."""
+        """Add users to the bot's list of moderators. Separate IDs with spaces; either all of them are added, or none are."""
 
-        new_moderators = new_moderators.split()
+        added = await self.bot.moderator_registry.add([int(mod) for mod in new_moderators.split()])
 
-        with open('config/server_vars.json', 'r') as server_vars_file:
-            data = json.load(server_vars_file)
+        if not added:
+            await ctx.send(embed=self.bot.simple_embed('That/those user(s) were already on the list of moderators.'))
+            return
+        await ctx.send(embed=self.bot.simple_embed(f'{", ".join(f"<@{mod}>" for mod in added)} are now on the list of moderators.'))
 
-        for mod in new_moderators:
-            mod = int(mod)
-            if mod not in data['moderator_ids']:
-                data['moderator_ids'].append(mod)
+    @admin.command(name='removemoderator', aliases=['removemod', 'moderatorremove', 'delmod', 'rmmod', 'modrm', 'moddel', 'removemoderators'])
+    async def remove_moderators(self, ctx: commands.Context, *, del_moderators: str):
+        """Remove users from the bot's list of moderators. Separate IDs with spaces; either all of them are removed, or none are."""
 
-        with open('config/server_vars.json', 'w') as server_vars_file:
-            json.dump(data, server_vars_file)
+        removed = await self.bot.moderator_registry.remove([int(mod) for mod in del_moderators.split()])
 
-        self.bot.moderator_ids = data['moderator_ids'].copy()
+        if not removed:
+            await ctx.send(embed=self.bot.simple_embed("That/those user(s) weren't on the list of moderators."))
+            return
+        await ctx.send(embed=self.bot.simple_embed(f'{", ".join(f"<@{mod}>" for mod in removed)} are no longer on the list of moderators.'))
 
-        await ctx.send(embed=self.bot.simple_embed('That/those user(s) are now on the list of moderators.'))
+    @admin.command()
+    async def moderators(self, ctx: commands.Context):
+        """Shows a list of the current moderators in the bot, and the roles that make members moderators."""
 
-    @admin.command(name='removemoderator', aliases=['removemod', 'moderatorremove', 'delmod', 'rmmod', 'modrm', 'moddel', 'removemoderators'])
-    async def remove_moderators(self, ctx: commands.Context, *, del_moderators: str):
-        """Remove users from the bot's list of moderators."""
+        moderator_ids = list(self.bot.moderator_registry)
+        moderators_str = f'Moderators registered in the bot ({len(moderator_ids)}): {", ".join(f"<@{mod}> ({mod})" for mod in moderator_ids)}'
 
-        del_moderators = del_moderators.split()
+        role_ids = sorted(self.bot.access_policy.moderator_role_ids)
+        if role_ids:
+            moderators_str += f'\n\nModerator roles: {", ".join(f"<@&{role_id}>" for role_id in role_ids)}'
+            if not self.bot.intents.members:
+                moderators_str += "\nMembers with them can't be listed: the member list isn't cached (low_memory_mode is on)."
+            else:
+                # each role keeps track of its members, so this doesn't go through the whole member list
+                role_moderators = {member.id for role in map(ctx.guild.get_role, role_ids) if role is not None for member in role.members}
+                moderators_str += f'\nMembers with them ({len(role_moderators)}): {", ".join(f"<@{mod}>" for mod in sorted(role_moderators)) or "none"}'
 
-        with open('config/server_vars.json', 'r') as server_vars_file:
-            data = json.load(server_vars_file)
+        await ctx.send(embed=self.bot.simple_embed(moderators_str[:4096]))
 
-        for mod in del_moderators:
-            mod = int(mod)
-            if mod in data['moderator_ids']:
-                data['moderator_ids'].remove(mod)
+    @commands.Cog.listener()
+    async def on_member_update(self, before: discord.Member, after: discord.Member):
+        if before.roles != after.roles:
+            self.bot.access_policy.invalidate_member(after.id)
 
-        with open('config/server_vars.json', 'w') as server_vars_file:
-            json.dump(data, server_vars_file)
+    @commands.Cog.listener()
+    async def on_member_remove(self, member: discord.Member):
+        self.bot.access_policy.invalidate_member(member.id)
 
-        self.bot.moderator_ids = data['moderator_ids'].copy()
+    @admin.command(name='loglevel', aliases=['logging', 'setloglevel'])
+    async def log_level(self, ctx: commands.Context, level: str = None, logger_name: str = 'discord'):
+        """Shows or changes how much the bot writes to its log file, until the next restart.
 
-        await ctx.send(embed=self.bot.simple_embed('That/those user(s) are no longer on the list of moderators.'))
+        Syntax: `;admin loglevel [DEBUG/INFO/WARNING/ERROR/CRITICAL] [logger, default discord]`.
+        For example, `;admin loglevel DEBUG discord.gateway` logs every gateway event; remember to turn it back down afterwards.
+        The level the bot starts with is `log_level` in server_vars.json."""
 
-    @admin.command()
-    async def moderators(self, ctx: commands.Context):
-        """Shows a list of the current moderators in the bot."""
+        logger = logging.getLogger(logger_name)
+
+        if level is None:
+            await ctx.send(embed=self.bot.simple_embed(f'The `{logger_name}` logger is logging at level `{logging.getLevelName(logger.getEffectiveLevel())}`.'))
+            return
 
-        with open('config/server_vars.json') as server_vars_file:
-            data = json.load(server_vars_file)
+        level = level.upper()
+        if level not in ('DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'):
+            await ctx.send(embed=self.bot.simple_embed(f'Error: `{level}` is not a log level. Use one of DEBUG, INFO, WARNING, ERROR or CRITICAL.'))
+            return
 
-        await ctx.send(embed=self.bot.simple_embed(f'IDs of moderators registered in the bot: {data["moderator_ids"]}'))
+        logger.setLevel(level)
+        logging.getLogger('discord').info('%s set the level of the %s logger to %s', ctx.author, logger_name, level)
+        await ctx.send(embed=self.bot.simple_embed(f'The `{logger_name}` logger is now logging at level `{level}`.'))
 
     @admin.error
     async def admin_error(self, ctx: commands.Context, error):
@@ -104,7 +132,7 @@ class Admin(commands.Cog):
         if isinstance(error, commands.NoPrivateMessage):
             await ctx.send(embed=self.bot.simple_embed('Error: command cannot be used in DMs.'))
         elif isinstance(error, commands.CheckFailure):
-            if ctx.author.id in self.bot.blacklisted_users:
+            if self.bot.access_policy.is_blacklisted(ctx.author.id):
                 return
             await ctx.send(embed=self.bot.simple_embed("You may not use this command."))
 
@@ -154,6 +182,16 @@ class Admin(commands.Cog):
             print_exception(
                 type(error), error, error.__traceback__, file=stderr)
 
+    @log_level.error
+    async def log_level_error(self, ctx: commands.Context, error):
+        if isinstance(error, commands.CommandInvokeError):
+            error = error.original
+        # All other errors not returned come here. And we can just print the default Traceback.
+        await ctx.send(embed=self.bot.simple_embed(f'Something went wrong: {error}'))
+        print('Ignoring exception in command {}:'.format(
+            ctx.command), file=stderr)
+        print_exception(type(error), error, error.__traceback__, file=stderr)
+
     @moderators.error
     async def moderators_error(self, ctx: commands.Context, error):
         if isinstance(error, commands.CommandInvokeError):
@@ -18,13 +18,13 @@ class Blacklist(commands.Cog):
     def cog_check(self, ctx: commands.Context):
  
        #Ignore blacklisted users unless they are mods or LonelyPenguin
-        return ctx.author.id not in self.bot.blacklisted_users or ctx.author.id in self.bot.moderator_ids or ctx.author.id == 305704400041803776
+        return self.bot.access_policy.may_use_bot(ctx.author.id)
 
     def mod_only():
         """Commands with this check will only execute for moderators."""
 
         def predicate(ctx: commands.Context):
-            return ctx.author.id in ctx.bot.moderator_ids
+            return ctx.bot.access_policy.is_moderator(ctx.author.id, ctx.author)
         return commands.check(predicate)
 
 # region blacklist commands and errors
@@ -45,16 +45,12 @@ class Blacklist(commands.Cog):
         Only moderators can use this command.
         Users will be notified that they are blacklisted."""
 
-        blacklisted = await self.bot.do_db_query(self.bot, 'SELECT * FROM blacklist WHERE userid=?', (user_to_blacklist.id,), "one")
-
-        if blacklisted:
+        if self.bot.access_policy.is_blacklisted(user_to_blacklist.id):
             await ctx.send(embed=self.bot.simple_embed('User is already blacklisted.'))
             return
 
-        await self.bot.do_db_query(self.bot, 'INSERT INTO blacklist VALUES (?,?,?)', (str(ctx.message.created_at)[:19], user_to_blacklist.id, user_to_blacklist.name))
-
-        blacklisted_users = await self.bot.do_db_query(self.bot, 'SELECT * FROM blacklist', None, "all")
-        self.bot.blacklisted_users = [each_row[1] for each_row in blacklisted_users]
+        await self.bot.storage.add_blacklisted_user(str(ctx.message.created_at)[:19], user_to_blacklist.id, user_to_blacklist.name)
+        self.bot.access_policy.blacklist(user_to_blacklist.id)
 
         mod_confirmed_blacklist_embed = discord.Embed(description=f'Blacklisted {user_to_blacklist.mention} from interacting with the modmail system.').set_author(
             name=self.embed_details['author name'], icon_url=self.embed_details['author icon'])
@@ -72,16 +68,12 @@ class Blacklist(commands.Cog):
         Users will be notified that they are unblacklisted.
         Add someone to the blacklist with `;blacklist add`."""
 
-        blacklisted = await self.bot.do_db_query(self.bot, 'SELECT * FROM blacklist WHERE userid=?', (user_to_unblacklist.id,), "one")
-
-        if not blacklisted:
+        if not self.bot.access_policy.is_blacklisted(user_to_unblacklist.id):
             await ctx.send(embed=self.bot.simple_embed('User is not blacklisted.'))
             return
 
-        await self.bot.do_db_query(self.bot, 'DELETE FROM blacklist WHERE userid=?', (user_to_unblacklist.id,))
-
-        blacklisted_users = await self.bot.do_db_query(self.bot, 'SELECT * FROM blacklist', None, "all")
-        self.bot.blacklisted_users = [each_row[1] for each_row in blacklisted_users]
+        await self.bot.storage.remove_blacklisted_user(user_to_unblacklist.id)
+        self.bot.access_policy.unblacklist(user_to_unblacklist.id)
 
         mod_confirmed_unblacklist_embed = discord.Embed(description=f'Removed {user_to_unblacklist.mention} from the blacklist. They can once again interact with the modmail system.').set_author(
             name=self.embed_details['author name'], icon_url=self. embed_details['author icon'])
@@ -98,7 +90,7 @@ class Blacklist(commands.Cog):
         Blacklist someone with `;blacklist add` and unblacklist them with `;blacklist remove`.
         Only moderators can use this command."""
 
-        full_blacklist_table = await self.bot.do_db_query(self.bot, 'SELECT * FROM blacklist', None, "all")
+        full_blacklist_table = await self.bot.storage.get_blacklist()
 
         blacklist_entries = StringIO()
         blacklist_entries.write('timestamp (UTC), userid, username\n\n')
@@ -121,7 +113,7 @@ class Blacklist(commands.Cog):
         if isinstance(error, commands.NoPrivateMessage):
             await ctx.send(embed=self.bot.simple_embed('Error: command cannot be used in DMs.'))
         elif isinstance(error, commands.CheckFailure):
-            if ctx.author.id in self.bot.blacklisted_users:
+            if self.bot.access_policy.is_blacklisted(ctx.author.id):
                 return
             await ctx.send(embed=self.bot.simple_embed("You may not use this command."))
 
@@ -1,11 +1,15 @@
 import asyncio
-from io import StringIO
+import threading
+from io import BytesIO, StringIO
 from os import linesep
 from sys import exit
 
 import discord
 from discord.ext import commands
 
+from channel_deletion import delete_channels
+from profiler import StackSampler
+
 
 class DevCommands(commands.Cog):
     """Developer commands providing common shortcuts to make the testing and development of the bot easier.
@@ -15,24 +19,38 @@ class DevCommands(commands.Cog):
 
     def __init__(self, bot: commands.Bot):
         self.bot = bot
+        self.profiling = asyncio.Lock()
 
     def cog_check(self, ctx: commands.Context):
         """Ensure that only LonelyPenguin may use these commands."""
-        return ctx.message.author.id == 305704400041803776
+        return self.bot.access_policy.is_owner(ctx.message.author.id)
 
     @commands.command()
     async def deletemanychannels(self, ctx: commands.Context, *, list_of_ids: str):
         """A command that deletes all channels from IDs in a list.
 
-        List must be structured as '[id, id, id]', without quotes.
+        List must be structured as '[id, id, id]', without quotes (plain space-separated IDs work too).
+        Deletes as fast as Discord's rate limits allow, editing a progress message as it goes.
         This command is meant for use in development, as testing of the modmail system often leaves behind orphaned modmail channels. Not designed or tested for widespread use. Only responds to LonelyPenguin.
         """
 
-        ids_actual_int_list = list_of_ids.split()
-        for chnl_id in ids_actual_int_list:
-            fated_to_die_chnl = self.bot.get_channel(int(chnl_id))
-            await asyncio.sleep(3)
-            await fated_to_die_chnl.delete()
+        ids_actual_int_list = [int(chnl_id) for chnl_id in list_of_ids.strip('[]').replace(',', ' ').split()]
+        # channels that aren't cached are passed as bare IDs and looked up before they are deleted
+        fated_to_die_chnls = [self.bot.get_channel(chnl_id) or chnl_id for chnl_id in ids_actual_int_list]
+
+        progress_message = await ctx.send(f'Deleting {len(fated_to_die_chnls)} channels...')
+        last_edit = 0.0
+
+        async def report_progress(summary):
+            nonlocal last_edit
+            # editing a message is rate limited too, so only do it every couple of seconds
+            if summary.done < summary.total and summary.elapsed - last_edit < 2:
+                return
+            last_edit = summary.elapsed
+            await progress_message.edit(content=f'Deleting channels: {summary.done}/{summary.total}')
+
+        summary = await delete_channels(fated_to_die_chnls, reason=f'deletemanychannels by {ctx.author}', progress=report_progress, fetch_channel=self.bot.fetch_channel)
+        await ctx.send(str(summary))
         await ctx.message.add_reaction('👍')
 
     @commands.command()
@@ -43,7 +61,7 @@ class DevCommands(commands.Cog):
         Not designed or tested for widespread use. Only responds to LonelyPenguin.
         """
 
-        full_activemodmails_table = await self.bot.do_db_query(self.bot, 'SELECT * FROM activemodmails', None ,"all")
+        full_activemodmails_table = await self.bot.storage.get_active_modmails()
 
         paginator = commands.Paginator(prefix='```\nuserid, modmailchnlid, reason\n')
 
@@ -83,7 +101,7 @@ class DevCommands(commands.Cog):
 
         user_id = int(user_id)
 
-        rows = await self.bot.do_db_query(self.bot, 'SELECT * FROM activemodmails WHERE userid=?', (user_id,), "all")
+        rows = await self.bot.storage.get_user_modmails(user_id)
         my_str = '```userid, modmailchnlid, reason\n\n'
         my_str += '\n'.join([str(row) for row in rows])
         my_str += '```'
@@ -102,7 +120,7 @@ class DevCommands(commands.Cog):
             if str(reaction) in confirm_send:  # if user confirms
                 await ctx.send(f'Okay, removing the database entries tied to <@{user_id}>.')
 
-                await self.bot.do_db_query(self.bot, 'DELETE FROM activemodmails WHERE userid=?', (user_id,))
+                await self.bot.active_modmails.remove_user(user_id)
 
                 await ctx.send('Done.')
 
@@ -112,6 +130,41 @@ class DevCommands(commands.Cog):
         except asyncio.TimeoutError:  # if 30 seconds pass without user confirming or canceling
             await ctx.send('Timed out, process cancelled.')
 
+    @commands.command(aliases=['prof'])
+    async def profile(self, ctx: commands.Context, seconds: float = 10.0, top: int = 15):
+        """Samples what every thread (including the event loop) is doing for a number of seconds.
+
+        Replies with the hottest functions on the event loop, by own time and including callees, plus a file of collapsed
+        stacks for all threads (open it in https://speedscope.app or feed it to flamegraph.pl).
+        Syntax: `;profile [seconds, max 300] [number of functions to list]`.
+        Not designed or tested for widespread use. Only responds to LonelyPenguin.
+        """
+
+        if self.profiling.locked():
+            await ctx.send('A profile is already being taken.')
+            return
+
+        seconds = min(max(seconds, 0.1), 300.0)
+        async with self.profiling:
+            await ctx.send(f'Profiling for {seconds:g} seconds...')
+            sampler = StackSampler()
+            await asyncio.to_thread(sampler.sample, seconds)
+
+        loop_thread = threading.current_thread().name  # the thread this command (and so the event loop) runs in
+        own, inclusive = sampler.top(top, thread_name=loop_thread)
+
+        def table(rows):
+            return '\n'.join(f'{samples / sampler.samples:6.1%}  {function}' for function, samples in rows) or 'no samples'
+
+        summary = f'{sampler.samples} samples over {seconds:g}s. Hottest functions on the event loop ({loop_thread}):\n\nOwn time:\n{table(own)}\n\nIncluding callees:\n{table(inclusive)}'
+        paginator = commands.Paginator()
+        for line in summary.splitlines():
+            paginator.add_line(line[:1900])
+        for page in paginator.pages:
+            await ctx.send(page)
+
+        await ctx.send(file=discord.File(BytesIO(sampler.collapsed().encode('utf-8')), filename=f'profile-{str(ctx.message.created_at)[:19].replace(" ", "_").replace(":", "-")}.collapsed.txt'))
+
     @commands.command(name="quit")
     async def quit_bot(self, ctx: commands.Context):
         await ctx.send("Quitting.")
@@ -0,0 +1,270 @@
+from datetime import datetime, timedelta, timezone
+from sys import stderr
+from traceback import print_exception
+
+import discord
+from discord.ext import commands, tasks
+from discord.utils import snowflake_time
+
+from attachments import upload_limit
+from channel_deletion import delete_channels
+
+
+class ReconciliationReport:
+    """What a reconciliation pass found (and, if it repaired anything, what it fixed)."""
+
+    def __init__(self):
+        self.orphan_rows = []  # rows whose modmail channel no longer exists in the modmail category
+        self.orphan_channels = []  # channels in the modmail category that no row points to
+        self.unlogged = []  # orphan rows and channels left alone because their log couldn't be sent
+        self.index_out_of_sync = False  # whether the in-memory index disagreed with the database
+        self.repaired = False
+        self.deletion = None  # DeletionSummary of the orphan channels, if they were deleted
+        self.finished_at = None
+
+    @property
+    def clean(self):
+        return not (self.orphan_rows or self.orphan_channels or self.index_out_of_sync)
+
+    def summary(self):
+        if self.clean:
+            return 'No problems found: the database and the modmail channels match.'
+
+        lines = []
+        if self.orphan_rows:
+            lines.append(f'**Database entries without a channel** ({len(self.orphan_rows)}): ' + ', '.join(f'<@{row[0]}> (channel {row[1]})' for row in self.orphan_rows))
+        if self.orphan_channels:
+            lines.append(f'**Channels without a database entry** ({len(self.orphan_channels)}): ' + ', '.join(f'<#{channel.id}>' for channel in self.orphan_channels))
+        if self.index_out_of_sync:
+            lines.append("**The bot's in-memory list of modmails didn't match the database.**")
+        lines.append('These have been repaired; their logs were sent to the logs channel.' if self.repaired else 'Use `;reconcile repair` to fix them.')
+        if self.unlogged:
+            lines.append(f"**Left as they were, because their log couldn't be sent** ({len(self.unlogged)}); they will be tried again next time.")
+        if self.deletion is not None:
+            lines.append(str(self.deletion))
+        return '\n\n'.join(lines)
+
+
+class Maintenance(commands.Cog):
+    """Keeps the modmail database and the modmail channels in sync.
+
+    Periodically compares the activemodmails table against the channels in the modmail category, and reports
+    (or, if `reconcile_auto_repair` is set in server_vars.json, repairs) anything that doesn't match.
+    """
+
+    def __init__(self, bot: commands.Bot):
+        self.bot = bot
+        self.auto_repair = self.bot.server_vars.get('reconcile_auto_repair', False)
+        # channels in the modmail category that aren't modmails (e.g. an instructions channel)
+        self.ignored_channel_ids = set(self.bot.server_vars.get('modmail_category_ignored_channel_ids', []))
+        # a channel (or row) this new may belong to a modmail that is still being opened, or that the cache hasn't caught up with
+        self.new_channel_grace = timedelta(minutes=5)
+        self.last_report = None
+
+        self.reconcile_loop.change_interval(minutes=self.bot.server_vars.get('reconcile_interval_minutes', 30))
+        self.reconcile_loop.start()
+
+    def cog_unload(self):
+        self.reconcile_loop.cancel()
+
+    def cog_check(self, ctx: commands.Context):
+
+       # Ignore blacklisted users unless they are mods or LonelyPenguin
+        return self.bot.access_policy.may_use_bot(ctx.author.id)
+
+    def mod_only():
+        """Commands with this check will only execute for moderators."""
+
+        def predicate(ctx: commands.Context):
+            return ctx.bot.access_policy.is_moderator(ctx.author.id, ctx.author)
+        return commands.check(predicate)
+
+    async def reconcile(self, repair: bool = False):
+        """Compare the activemodmails table with the modmail category's channels in one pass.
+
+        The channels are taken from the bot's cache and the table is read once, so this makes no API calls unless it is
+        asked to repair what it found. Repairing never loses a conversation: the log of every orphan row and channel is
+        sent to the logs channel first (as when a modmail is closed), and anything whose log can't be sent is left alone.
+
+        The UNIQUE indexes added by migration 2 mean there can't be duplicate rows, so they aren't looked for.
+
+        :param repair: Whether to fix what was found, rather than only report it.
+        :return: ReconciliationReport
+        """
+
+        report = ReconciliationReport()
+
+        rows = await self.bot.storage.get_active_modmails()
+        modmail_category = self.bot.get_channel(self.bot.modmail_category_id)
+        channels = {channel.id: channel for channel in modmail_category.channels}
+        too_new = datetime.now(timezone.utc) - self.new_channel_grace
+
+        rows_by_channel = {}
+        for row in rows:
+            rows_by_channel[row[1]] = row
+            # a modmail's channel is created over REST before its row is added, but can reach the cache after it
+            if row[1] not in channels and snowflake_time(row[1]) <= too_new:
+                report.orphan_rows.append(row)
+
+        for channel_id, channel in channels.items():
+            if channel_id in rows_by_channel or channel_id in self.ignored_channel_ids:
+                continue
+            if channel.created_at.replace(tzinfo=timezone.utc) > too_new:
+                continue
+            report.orphan_channels.append(channel)
+
+        report.index_out_of_sync = sorted(tuple(row) for row in rows) != sorted(self.bot.active_modmails)
+
+        if repair and not report.clean:
+            for row in report.orphan_rows:
+                if await self.send_log(row[1], None, f'Modmail with <@{row[0]}> was forgotten by reconciliation: its channel no longer exists. Modmail reason was `{row[2]}`.', f'log-{row[0]}-{row[2]}'):
+                    await self.bot.active_modmails.forget(row[1])
+                else:
+                    report.unlogged.append(row)
+
+            logged_channels = []
+            for channel in report.orphan_channels:
+                if await self.send_log(channel.id, channel, f'Channel #{channel.name} was deleted by reconciliation: no modmail was attached to it.', f'log-{channel.name}'):
+                    logged_channels.append(channel)
+                else:
+                    report.unlogged.append(channel)
+            if logged_channels:
+                report.deletion = await delete_channels(logged_channels, reason='Modmail channel without a database entry')
+                for channel in logged_channels:
+                    await self.bot.active_modmails.forget(channel.id)
+
+            await self.bot.active_modmails.load()
+            report.repaired = True
+
+        report.finished_at = datetime.now(timezone.utc)
+        self.last_report = report
+        return report
+
+    async def send_log(self, modmailchnlid: int, modmail_channel, notice: str, log_name: str):
+        """Send what is known of a modmail's conversation to the logs channel, before it is forgotten or deleted.
+
+        :param modmail_channel: The modmail's channel, whose history is read for anything the transcript doesn't cover; None if it is gone.
+        :return: Whether the log was sent.
+        """
+
+        try:
+            logs_channel = await self.bot.resolver.channel(self.bot.logs_channel_id)
+            log_files = await self.bot.transcripts.log_files(
+                modmailchnlid, modmail_channel, f'{log_name}-{str(datetime.now(timezone.utc))[:10]}.txt', upload_limit(logs_channel))
+            await logs_channel.send(embed=self.bot.simple_embed(notice))
+            for dpy_compatible_log in log_files:
+                await logs_channel.send(file=dpy_compatible_log)
+            return True
+        except (discord.HTTPException, AttributeError) as error:
+            print(f'Reconciliation could not send the log of {modmailchnlid}, so left it alone: {error!r}', file=stderr)
+            return False
+
+    @tasks.loop(minutes=30)
+    async def reconcile_loop(self):
+        try:
+            report = await self.reconcile(repair=self.auto_repair)
+            if not report.clean:
+                print(f'Reconciliation found problems (repaired: {report.repaired}): {len(report.orphan_rows)} orphan rows, '
+                      f'{len(report.orphan_channels)} orphan channels, index out of sync: {report.index_out_of_sync}, {len(report.unlogged)} left because their log could not be sent')
+        except Exception as error:
+            print('Ignoring exception in reconciliation task:', file=stderr)
+            print_exception(type(error), error, error.__traceback__, file=stderr)
+
+    @reconcile_loop.before_loop
+    async def before_reconcile_loop(self):
+        await self.bot.wait_until_ready()
+
+# region reconcile commands and errors
+    @commands.group(name='reconcile', aliases=['sync', 'checkdb'], invoke_without_command=True)
+    @mod_only()
+    @commands.guild_only()
+    async def reconcile_cmd(self, ctx: commands.Context):
+        """Checks that every modmail in the database has a channel and vice-versa, and shows what doesn't match.
+
+        Runs automatically in the background; this runs it now.
+        Use `;reconcile repair` to fix what it finds, or `;reconcile last` to see the last background run's results.
+        Only moderators can use this command."""
+
+        report = await self.reconcile()
+        await ctx.send(embed=self.bot.simple_embed(report.summary()))
+
+    @reconcile_cmd.command(name='repair', aliases=['fix'])
+    @mod_only()
+    @commands.guild_only()
+    async def reconcile_repair(self, ctx: commands.Context):
+        """Fixes mismatches between the database and the modmail channels.
+
+        Forgets modmails whose channel is gone, and **deletes** channels in the modmail category that aren't attached to a modmail.
+        Either way, their log is sent to the logs channel first.
+        Only moderators can use this command."""
+
+        report = await self.reconcile(repair=True)
+        await ctx.send(embed=self.bot.simple_embed(report.summary()))
+
+    @reconcile_cmd.command(name='last', aliases=['show', 'report'])
+    @mod_only()
+    async def reconcile_last(self, ctx: commands.Context):
+        """Shows the results of the last reconciliation (background or manual).
+
+        Only moderators can use this command."""
+
+        if self.last_report is None:
+            await ctx.send(embed=self.bot.simple_embed('No reconciliation has run yet.'))
+            return
+
+        await ctx.send(embed=self.bot.simple_embed(f'Last run at {str(self.last_report.finished_at)[:19]} UTC:\n\n{self.last_report.summary()}'))
+
+    @reconcile_cmd.error
+    async def reconcile_error(self, ctx: commands.Context, error):
+        if isinstance(error, commands.CommandInvokeError):
+            error = error.original
+        if isinstance(error, commands.NoPrivateMessage):
+            await ctx.send(embed=self.bot.simple_embed('Error: command cannot be used in DMs.'))
+        elif isinstance(error, commands.CheckFailure):
+            if self.bot.access_policy.is_blacklisted(ctx.author.id):
+                return
+            await ctx.send(embed=self.bot.simple_embed("You may not use this command."))
+        else:
+            # All other errors not returned come here. And we can just print the default Traceback.
+            await ctx.send(embed=self.bot.simple_embed(f'Something went wrong: {error}'))
+            print('Ignoring exception in command {}:'.format(
+                ctx.command), file=stderr)
+            print_exception(
+                type(error), error, error.__traceback__, file=stderr)
+
+    @reconcile_repair.error
+    async def reconcile_repair_error(self, ctx: commands.Context, error):
+        if isinstance(error, commands.CommandInvokeError):
+            error = error.original
+        if isinstance(error, commands.NoPrivateMessage):
+            await ctx.send(embed=self.bot.simple_embed('Error: command cannot be used in DMs.'))
+        elif isinstance(error, commands.CheckFailure):
+            if self.bot.access_policy.is_blacklisted(ctx.author.id):
+                return
+            await ctx.send(embed=self.bot.simple_embed("You may not use this command."))
+        else:
+            # All other errors not returned come here. And we can just print the default Traceback.
+            await ctx.send(embed=self.bot.simple_embed(f'Something went wrong: {error}'))
+            print('Ignoring exception in command {}:'.format(
+                ctx.command), file=stderr)
+            print_exception(
+                type(error), error, error.__traceback__, file=stderr)
+
+    @reconcile_last.error
+    async def reconcile_last_error(self, ctx: commands.Context, error):
+        if isinstance(error, commands.CheckFailure):
+            if self.bot.access_policy.is_blacklisted(ctx.author.id):
+                return
+            await ctx.send(embed=self.bot.simple_embed("You may not use this command."))
+        else:
+            # All other errors not returned come here. And we can just print the default Traceback.
+            await ctx.send(embed=self.bot.simple_embed(f'Something went wrong: {error}'))
+            print('Ignoring exception in command {}:'.format(
+                ctx.command), file=stderr)
+            print_exception(
+                type(error), error, error.__traceback__, file=stderr)
+# endregion
+
+
+def setup(bot: commands.Bot):
+    bot.add_cog(Maintenance(bot))
@@ -1,3 +1,8 @@
+import time
+from datetime import timedelta
+from sys import stderr
+from traceback import print_exception
+
 import discord
 from discord.ext import commands
 
@@ -11,12 +16,80 @@ class Misc(commands.Cog):
     def cog_check(self, ctx: commands.Context):
 
        #Ignore blacklisted users unless they are mods or LonelyPenguin
-        return ctx.author.id not in self.bot.blacklisted_users or ctx.author.id == 305704400041803776 or ctx.author.id in self.bot.moderator_ids
+        return self.bot.access_policy.may_use_bot(ctx.author.id)
+
+    def mod_only():
+        """Commands with this check will only execute for moderators."""
+
+        def predicate(ctx: commands.Context):
+            return ctx.bot.access_policy.is_moderator(ctx.author.id, ctx.author)
+        return commands.check(predicate)
 
     @commands.command()
     async def ping(self, ctx: commands.Context):
         await ctx.send(f'Pong! Bot latency: {round(self.bot.latency * 1000, 2)} milliseconds.')
 
+    @commands.command(aliases=['metrics'])
+    @mod_only()
+    async def stats(self, ctx: commands.Context):
+        """Shows how the bot has been performing since it started.
+
+        Latencies are estimated from histograms, so they are approximate.
+        The full metrics are served in the Prometheus format on the bot's local metrics endpoint.
+        Only moderators can use this command."""
+
+        metrics = self.bot.metrics
+
+        def latency_str(histogram, **labels):
+            if histogram is None or not histogram.count(**labels):
+                return 'none yet'
+            return f'{histogram.count(**labels)}, p50 {histogram.quantile(0.5, **labels) * 1000:.0f} ms, p99 {histogram.quantile(0.99, **labels) * 1000:.0f} ms'
+
+        relays = metrics.get('modmail_relays_total')
+        failed_relays = sum(count for labels, count in relays.values.items() if ('outcome', 'relayed') not in labels) if relays else 0
+        rest_errors = metrics.get('discord_rest_errors_total')
+        lookups = metrics.get('resolver_lookups_total')
+        lookups_by_result = {}
+        for labels, count in (lookups.values.items() if lookups else ()):
+            result = dict(labels)['result']
+            lookups_by_result[result] = lookups_by_result.get(result, 0) + count
+
+        lines = [
+            f'**Uptime:** {timedelta(seconds=round(time.monotonic() - metrics.started_at))}',
+            f'**Gateway latency:** {round(self.bot.latency * 1000, 2)} ms',
+            f"**Active modmails:** {metrics.get('modmail_active_modmails').get()}",
+            f"**Pending confirmations:** {metrics.get('modmail_pending_confirmations').get() if metrics.get('modmail_pending_confirmations') else 0}",
+            '',
+            f"**Relays:** {latency_str(metrics.get('modmail_relay_seconds'))} ({failed_relays} failed)",
+            f"**DM listener:** {latency_str(metrics.get('modmail_listener_seconds'), listener='dm_modmail_listener')}",
+            f"**Modmail channel listener:** {latency_str(metrics.get('modmail_listener_seconds'), listener='guild_modmail_listener')}",
+            f"**Confirmations:** {latency_str(metrics.get('modmail_confirmation_wait_seconds'))} (time users took to answer)",
+            f"**Database queries:** {latency_str(metrics.get('db_query_seconds'))}",
+            f"**Database commits:** {latency_str(metrics.get('db_commit_seconds'))}",
+            f"**Discord API calls:** {latency_str(metrics.get('discord_rest_request_seconds'))} ({rest_errors.total() if rest_errors else 0} failed)",
+            f"**User/channel lookups:** {lookups.total() if lookups else 0} ({lookups_by_result.get('gateway', 0)} cached by discord.py, {lookups_by_result.get('cache', 0)} by the resolver, {lookups_by_result.get('fetched', 0)} fetched, {lookups_by_result.get('shared', 0)} shared a fetch, {lookups_by_result.get('failed', 0)} failed)",
+            f"**Event loop lag:** {latency_str(metrics.get('event_loop_lag_seconds'))}",
+            f"**Event loop stalls:** {latency_str(metrics.get('event_loop_stall_seconds'))}",
+        ]
+
+        await ctx.send(embed=self.bot.simple_embed('\n'.join(lines)))
+
+    @stats.error
+    async def stats_error(self, ctx: commands.Context, error):
+        if isinstance(error, commands.CommandInvokeError):
+            error = error.original
+        if isinstance(error, commands.CheckFailure):
+            if self.bot.access_policy.is_blacklisted(ctx.author.id):
+                return
+            await ctx.send(embed=self.bot.simple_embed('You may not use this command.'))
+        else:
+            # All other errors not returned come here. And we can just print the default Traceback.
+            await ctx.send(embed=self.bot.simple_embed(f'Something went wrong: {error}'))
+            print('Ignoring exception in command {}:'.format(
+                ctx.command), file=stderr)
+            print_exception(
+                type(error), error, error.__traceback__, file=stderr)
+
 
 def setup(bot: commands.Bot):
     bot.add_cog(Misc(bot))
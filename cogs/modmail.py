@@ -1,16 +1,16 @@
 # region imports
 import asyncio
-from functools import wraps
-from io import StringIO
-from re import sub
+import time
+from re import match, sub
 from sys import stderr
-from textwrap import fill
 from traceback import print_exception
 
 
 import discord
 from discord.ext import commands
 
+from attachments import ByteBudget, fetch_attachment_files, too_large_embed, upload_limit
+from relay_queue import RelayQueues
 from views import Confirm
 # endregion
 
@@ -36,6 +36,27 @@ class Modmail(commands.Cog):
         self.embed_details = {'author name': 'KotLC Chats Modmail',
                               'author icon': 'https://cdn.discordapp.com/attachments/743536411369799804/854865953083228181/mail_icon.png',
                               'footer': 'Use ;modmail close to close this modmail, and ;modmail reason to change its reason.'}
+        # how many of the destination's latest messages to search when a replied-to message has no recorded counterpart
+        self.reply_history_fallback_limit = 100
+        # shared by all relays, so that a burst of large attachments can't all be held in memory at once
+        self.attachment_download_slots = asyncio.Semaphore(4)
+        # attachment bytes all relays together may hold in memory, from download until sent
+        self.attachment_bytes = ByteBudget(self.bot.server_vars.get('attachment_memory_budget', 64 * 1024 ** 2))
+        # one ordered queue per modmail, so a slow relay can't let a later message overtake it
+        self.relay_queues = RelayQueues()
+        # seconds to wait for more messages to merge into one relay; 0 turns coalescing off
+        self.coalesce_window = self.bot.server_vars.get('relay_coalesce_window', 0)
+        self.relay_bursts = {}  # modmail channel ID -> messages waiting to be relayed together
+
+        self.listener_seconds = self.bot.metrics.histogram('modmail_listener_seconds', 'Time taken to handle a modmail message, by listener.')
+        self.relay_seconds = self.bot.metrics.histogram('modmail_relay_seconds', 'Time taken to relay a message, from the start of relay_message.')
+        self.relays = self.bot.metrics.counter('modmail_relays_total', 'Relayed messages, by direction and outcome.')
+        self.pending_confirmations = self.bot.metrics.gauge('modmail_pending_confirmations', 'Users being asked whether to open a modmail.')
+        self.confirmation_seconds = self.bot.metrics.histogram(
+            'modmail_confirmation_wait_seconds', 'Time users took to confirm (or cancel) opening a modmail.', (1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0))
+
+    def cog_unload(self):
+        asyncio.create_task(self.relay_queues.close())
 
     def cog_check(self, ctx: commands.Context):
         """Ensures that all commands in this cog only trigger when they are meant to.
@@ -43,34 +64,15 @@ class Modmail(commands.Cog):
         To successfully trigger a command, user must not be blacklisted from the bot, or must be LonelyPenguin or a moderator.
         """
        # Ignore blacklisted users unless they are mods or LonelyPenguin
-        return ctx.author.id not in self.bot.blacklisted_users or ctx.author.id == 305704400041803776 or ctx.author.id in self.bot.moderator_ids
+        return self.bot.access_policy.may_use_bot(ctx.author.id)
 
     def mod_only():
         """Commands with this check will only execute for moderators."""
 
         def predicate(ctx: commands.Context):
-            return ctx.author.id in ctx.bot.moderator_ids
+            return ctx.bot.access_policy.is_moderator(ctx.author.id, ctx.author)
         return commands.check(predicate)
 
-    def listener_check(listener):
-        """Decorator that ensures that listeners will only trigger when they are meant to (basic check).
-
-        Listeners decorated with this function will not trigger on blacklisted users, bots, or commands.
-        """
-
-        @wraps(listener)
-        async def wrapper_listener_check(*args, **kwargs):
-
-            self, message = args[0], args[1]
-            message_context = await self.bot.get_context(message)
-
-            if message.author.bot or message_context.command or message.author.id in self.bot.blacklisted_users:
-                return
-
-            await listener(*args, **kwargs)
-
-        return wrapper_listener_check
-
     # endregion
 
     # region open_modmail_func and relay_message
@@ -84,7 +86,7 @@ class Modmail(commands.Cog):
 
         Called by the DM message listener and the `;`modmail open` command."""
 
-        modmail_user = self.bot.get_user(modmailuserid)
+        modmail_user = await self.bot.resolver.user(modmailuserid)
 
         if len(messagectx.content) >= 1910:
             await messagectx.add_reaction('✂')
@@ -93,7 +95,7 @@ class Modmail(commands.Cog):
         if not from_user:
             opening_modmail_message = await modmail_user.send(embed=self.bot.simple_embed('Opening a new modmail...'))
 
-        modmail_entry = await self.bot.do_db_query(self.bot, 'SELECT * FROM activemodmails WHERE userid=?', (modmail_user.id,), "one")
+        modmail_entry = self.bot.active_modmails.by_user(modmail_user.id)
 
         if modmail_entry:  # if a modmail is already attached to this user
             avoid_duplicate_modmail_embed = self.bot.simple_embed(
@@ -108,14 +110,21 @@ class Modmail(commands.Cog):
                 await messagectx.channel.send(message_content)
             return
 
-        my_guild = self.bot.get_guild(self.bot.server_id)
-        modmail_private_cat = my_guild.get_channel(
-            self.bot.modmail_category_id)
+        modmail_private_cat = await self.bot.resolver.channel(self.bot.modmail_category_id)
         modmail_channel = await modmail_private_cat.create_text_channel(f'{modmail_user.name}{modmail_user.discriminator}')
         
-        new_row = (modmail_user.id, modmail_channel.id, modmailreason)
-        
-        await self.bot.do_db_query(self.bot, 'INSERT INTO activemodmails VALUES (?,?,?)', new_row)
+        new_row = await self.bot.active_modmails.add(modmail_user.id, modmail_channel.id, modmailreason)
+
+        # queued straight away, so that messages sent while the modmail is being announced are relayed after this one
+        await self.relay_queues.submit(modmail_channel.id, self.announce_modmail, messagectx, new_row, from_user, modmail_user, modmail_channel, message_content)
+
+    async def announce_modmail(self, messagectx: discord.Message, new_row: tuple, from_user: bool, modmail_user: discord.User, modmail_channel: discord.TextChannel, message_content: str):
+        """Sends the opening notices of a new modmail to the user and the moderators, then relays its first message.
+
+        Runs as the first job in the new modmail's relay queue; see open_modmail_func.
+        """
+
+        modmailreason = new_row[2]
 
         if from_user:
             mod_modmail_opened_embed = discord.Embed(description=f"New modmail from {messagectx.author.mention} (see their message below). Send a message in this channel to respond.\n\nA ✅ on your message means it's been successfully relayed, and a ✂️ means it has been cut to stay within the character limit.").set_author(
@@ -134,122 +143,272 @@ class Modmail(commands.Cog):
                 name=self.embed_details['author name'], icon_url=self.embed_details['author icon']).set_footer(text=self.embed_details['footer'])
 
         await modmail_user.send(embed=user_modmail_opened_embed)
-        await modmail_channel.send(embed=mod_modmail_opened_embed)
+        mod_modmail_opened_msg = await modmail_channel.send(embed=mod_modmail_opened_embed)
+        await self.bot.transcripts.start(modmail_channel.id, mod_modmail_opened_msg)
 
         await self.relay_message(messagectx, new_row, from_user)
 
-    async def relay_message(self, messagectx: discord.Message, row: tuple, from_user: bool):
+    async def relay_message(self, messagectx: discord.Message, row: tuple, from_user: bool, coalesced: list = ()):
         """Relays a message from a DMing user to moderators, or vice-versa.
 
         :param messagectx: discord.Message object– the message to be relayed.
         :param row: Database row associated with the modmail.
         :param from_user: Whether the message is from a DMing user (otherwise, from a moderator).
+        :param coalesced: Further plain-text messages by the same author, sent right after messagectx, to merge into the same relayed message (see queue_relay).
         """
 
+        started_at = time.perf_counter()
+        direction = 'to_moderators' if from_user else 'to_user'
+
         if len(messagectx.content) >= 1960:
             await messagectx.add_reaction('✂')
-        message_content = messagectx.content[:1959]
-
-        if from_user:
-            destination = self.bot.get_channel(row[1])
-        else:  # if in modmail channel
-            destination = self.bot.get_user(row[0])
+        message_content = '\n'.join([messagectx.content[:1959]] + [message.content for message in coalesced])
+        relayed_message = None
 
         try:
-            kwargs = {}
-            
-            if messagectx.attachments:
-                discordable_files = [(await x.to_file()) for x in messagectx.attachments]
-                kwargs['files'] = discordable_files
+            if from_user:
+                destination = await self.bot.resolver.channel(row[1])
+            else:  # if in modmail channel
+                destination = await self.bot.resolver.user(row[0])
+
+            kwargs = {'embeds': []}
 
             if messagectx.reference and messagectx.reference.resolved:
-                reply = messagectx.reference.resolved
+                kwargs['embeds'].append(await self.reply_embed(messagectx.reference.resolved, destination))
+
+            # the downloaded attachments count against the shared byte budget until they have been sent
+            async with fetch_attachment_files(messagectx.attachments, upload_limit(destination), self.attachment_download_slots, self.attachment_bytes) as (downloaded_attachments, too_large_attachments):
 
-                if reply.author.id == self.bot.user.id:
-                    reply.content = sub('\*\*.*?\*\*: ', '', reply.content, count=1)
+                # keep a local copy for the log without holding up the relay (the files are closed once sent)
+                for attachment, discordable_file in downloaded_attachments:
+                    self.bot.attachment_archive.schedule(row[1], messagectx.id, attachment, discordable_file.fp.getvalue())
+                for attachment in too_large_attachments:
+                    self.bot.attachment_archive.schedule(row[1], messagectx.id, attachment)
 
-                link_message = reply
-                async for msg in destination.history():
-                    if msg.author.id == self.bot.user.id:
-                        msg.content = sub('\*\*.*?\*\*: ', '', msg.content, count=1)
-                    if msg.content == reply.content:
-                        link_message = msg
-                        reply_to_str = f'[**Reply to:**]({msg.jump_url} "Jump to message")'
-                        break
-                    else: 
-                        reply_to_str = f'**Reply to:**'
+                if downloaded_attachments:
+                    kwargs['files'] = [discordable_file for _, discordable_file in downloaded_attachments]
+                if too_large_attachments:
+                    kwargs['embeds'].append(too_large_embed(too_large_attachments))
 
-                quote_end = ' ...' if len(link_message.content) > 100 else ''
+                relayed_message = await destination.send(f'**{messagectx.author.name}**: {message_content}', **kwargs)
 
-                embed = discord.Embed(description=f'{reply_to_str} {link_message.content[:100]}{quote_end}')
-                embed.set_author(name=link_message.author.name)
-                kwargs['embeds'] = [embed]
+            await self.bot.storage.add_relayed_messages([message.id for message in [messagectx, *coalesced]], relayed_message.id, row[1])
 
-            await destination.send(f'**{messagectx.author.name}**: {message_content}', **kwargs)
+            # transcripts log the original message; replies to a relayed copy are logged as replies to its original
+            replyto = None
+            if messagectx.reference and messagectx.reference.resolved:
+                replyto = await self.bot.storage.get_relayed_source(messagectx.reference.resolved.id) or messagectx.reference.resolved.id
+            await self.bot.transcripts.append(row[1], messagectx, replyto=replyto)
+            for message in coalesced:
+                await self.bot.transcripts.append(row[1], message)
 
-            await messagectx.add_reaction('✅')
+            for message in [messagectx, *coalesced]:
+                await message.add_reaction('✅')
+            self.relays.inc(1 + len(coalesced), direction=direction, outcome='relayed')
 
         except discord.Forbidden as error:
+            self.relays.inc(direction=direction, outcome='forbidden')
             await messagectx.channel.send(embed=self.bot.simple_embed(f"Error: Couldn't send a message to this user; they have probably blocked the bot. Try DMing them directly. (Alternatively, bot can't add a reaction to your message.) ({error})"))
-        except AttributeError as error:
+        except (AttributeError, discord.NotFound) as error:
+            self.relays.inc(direction=direction, outcome='no_access')
             await messagectx.channel.send(embed=self.bot.simple_embed(f"Error: Bot probably doesn't have access to that user or that channel. ({error})"))
         except Exception as error:
+            self.relays.inc(direction=direction, outcome='error')
             await messagectx.channel.send(embed=self.bot.simple_embed(f'Something went wrong: {error}'))
             # All other errors not returned come here. And we can just print the default Traceback.
             print('Ignoring exception in function relay_message:', file=stderr)
             print_exception(
                 type(error), error, error.__traceback__, file=stderr)
+        finally:
+            self.relay_seconds.observe(time.perf_counter() - started_at, direction=direction)
+
+        # a message that failed to relay is still part of the conversation, so it is logged as not delivered
+        if relayed_message is None:
+            for message in [messagectx, *coalesced]:
+                await self.bot.transcripts.append_undelivered(row[1], message)
+
+    def queue_relay(self, message: discord.Message, row: tuple, from_user: bool):
+        """Queues a message to be relayed in its modmail's relay queue.
+
+        If burst coalescing is on (`relay_coalesce_window` in server_vars.json, in seconds), plain-text messages that the same
+        author sends within that window of the first one are merged into one relayed message, as long as it stays within the
+        character limit. This saves a send per message when users send several short messages in a row.
+
+        :param message: The message to relay.
+        :param row: Database row associated with the modmail.
+        :param from_user: Whether the message is from a DMing user (otherwise, from a moderator).
+        """
+
+        modmailchnlid = row[1]
+        burst = self.relay_bursts.get(modmailchnlid)
+        coalescable = self.coalesce_window > 0 and message.content and not message.attachments and not message.reference and len(message.content) < 1960
+
+        if coalescable and burst and burst[0].author.id == message.author.id and sum(len(queued.content) + 1 for queued in burst) + len(message.content) <= 1959:
+            burst.append(message)
+            return
+
+        # anything that can't join the current burst ends it, so that messages are still relayed in order
+        self.relay_bursts.pop(modmailchnlid, None)
+
+        if coalescable:
+            burst = self.relay_bursts[modmailchnlid] = [message]
+            # held back in the queue (without taking a relay slot) until the window is up
+            self.relay_queues.submit_at(asyncio.get_running_loop().time() + self.coalesce_window, modmailchnlid, self.relay_burst, burst, row, from_user)
+        else:
+            # relay_message reports its own errors in the channel
+            self.relay_queues.submit(modmailchnlid, self.relay_message, message, row, from_user)
+
+    def queue_transcript_entry(self, message: discord.Message, row: tuple):
+        """Queues a message in a modmail channel that isn't relayed (a command, or from another bot) to be logged.
+
+        It goes through the modmail's relay queue, so it is logged after the messages sent before it.
+        """
+
+        self.relay_bursts.pop(row[1], None)  # like any message that can't join the current burst, it ends it
+        self.relay_queues.submit(row[1], self.bot.transcripts.append, row[1], message)
+
+    async def relay_burst(self, burst: list, row: tuple, from_user: bool):
+        """Relays a burst of messages as one message, once the coalesce window is up. Queued by queue_relay."""
+
+        if self.relay_bursts.get(row[1]) is burst:
+            del self.relay_bursts[row[1]]
+
+        await self.relay_message(burst[0], row, from_user, coalesced=burst[1:])
+
+    async def reply_embed(self, reply: discord.Message, destination):
+        """Builds the "Reply to:" embed attached to a relayed reply, linking to the replied-to message's counterpart in the destination.
+
+        The counterpart is looked up in the relayedmessages table. Messages relayed before that table existed fall back to
+        scanning the most recent page of the destination's history for a message with the same content.
+
+        :param reply: The message being replied to.
+        :param destination: Where the reply is being relayed to (modmail channel or user).
+        """
+
+        author_name = reply.author.name
+        reply_content = reply.content
+        if reply.author.id == self.bot.user.id:  # relayed messages are prefixed with the original author's name
+            relayed_author = match(r'\*\*(.*?)\*\*: ', reply_content)
+            if relayed_author:
+                author_name = relayed_author.group(1)
+                reply_content = reply_content[relayed_author.end():]
+
+        reply_to_str = '**Reply to:**'
+
+        counterpart_id = await self.bot.storage.get_relayed_counterpart(reply.id)
+
+        if counterpart_id is not None:
+            destination_channel = destination if isinstance(destination, discord.abc.GuildChannel) else (destination.dm_channel or await destination.create_dm())
+            jump_url = destination_channel.get_partial_message(counterpart_id).jump_url
+            reply_to_str = f'[**Reply to:**]({jump_url} "Jump to message")'
+        else:
+            async for msg in destination.history(limit=self.reply_history_fallback_limit):
+                msg_content = sub(r'\*\*.*?\*\*: ', '', msg.content, count=1) if msg.author.id == self.bot.user.id else msg.content
+                if msg_content == reply_content:
+                    reply_to_str = f'[**Reply to:**]({msg.jump_url} "Jump to message")'
+                    break
+
+        quote_end = ' ...' if len(reply_content) > 100 else ''
+
+        embed = discord.Embed(description=f'{reply_to_str} {reply_content[:100]}{quote_end}')
+        embed.set_author(name=author_name)
+        return embed
 
     # endregion
 
-    # region the listeners themselves, which call the two functions above and have catch-all error handling
-    @listener_check
+    # region the listener itself and the DM/guild handlers it dispatches to, which call the two functions above and have catch-all error handling
     @commands.Cog.listener(name='on_message')
-    async def dm_modmail_listener(self, message: discord.Message):
-        """Listens for DM messages and handles relaying or opening modmails from there."""
+    async def modmail_dispatcher(self, message: discord.Message):
+        """Single on_message listener for the modmail system.
 
+        Cheap checks run first (bots, messages outside DMs and modmail channels, blacklisted users), so ordinary guild chat
+        is dropped without being parsed. The command context is then built once, and messages that are not commands are
+        handed to the DM or the guild handler along with their modmail row.
+        """
+
+        if message.author.id == self.bot.user.id:  # the bot's own messages are logged as they are sent, or are relayed copies
+            return
+
+        if message.guild is None:
+            handler = self.dm_modmail_listener
+            modmail_entry = self.bot.active_modmails.by_user(message.author.id)
+        elif message.channel.category_id == self.bot.modmail_category_id:
+            handler = self.guild_modmail_listener
+            modmail_entry = self.bot.active_modmails.by_channel(message.channel.id)
+            if modmail_entry is None:  # channel in modmail category, but not an active modmail
+                return
+        else:
+            return
+
+        if message.author.bot or self.bot.access_policy.is_blacklisted(message.author.id):
+            if message.guild is not None:
+                self.queue_transcript_entry(message, modmail_entry)
+            return
+
+        message_context = await self.bot.get_context(message)
+        if message_context.command:
+            if message.guild is not None:
+                self.queue_transcript_entry(message, modmail_entry)
+            return
+
+        started_at = time.perf_counter()
+        waited = 0.0
         try:
+            waited = await handler(message, modmail_entry) or 0.0
+        finally:
+            # a DM that opens a new modmail waits for the user to confirm; that is recorded in confirmation_seconds instead
+            self.listener_seconds.observe(time.perf_counter() - started_at - waited, listener=handler.__name__)
+
+    async def dm_modmail_listener(self, message: discord.Message, modmail_entry: tuple):
+        """Handles a DM message by relaying it, or by opening a new modmail if the user doesn't have one.
 
-            if message.guild is None:  # if in DM
+        :param message: The DM message (not a command, not from a bot or a blacklisted user).
+        :param modmail_entry: Row of the user's active modmail, or None.
+        :return: Seconds spent waiting for the user to confirm opening a modmail (0 if they weren't asked).
+        """
 
-                modmail_entry = await self.bot.do_db_query(self.bot, 'SELECT * FROM activemodmails WHERE userid=?', (message.author.id,), "one")
+        waited = 0.0
+        try:
 
-                if modmail_entry is not None:  # if message part of an active modmail, relay message
-                    try:
-                        await self.relay_message(message, modmail_entry, True)
-                    except discord.Forbidden as error:
-                        await message.channel.send(embed=self.bot.simple_embed(f'Error: bot lacks permissions to relay your message. Please contact a moderator directly. ({error})'))
+            if modmail_entry is not None:  # if message part of an active modmail, queue it to be relayed
+                self.queue_relay(message, modmail_entry, True)
 
-                else:  # if message not part of an active modmail, create modmail
+            else:  # if message not part of an active modmail, create modmail
 
-                    if len(message.content) >= 1910:
-                        await message.add_reaction('✂')
-                    msg_content = message.content[:1909]
+                if len(message.content) >= 1910:
+                    await message.add_reaction('✂')
+                msg_content = message.content[:1909]
 
-                    initiate_modmail_embed = discord.Embed(description=f'Please confirm that you would like to open a modmail and relay your message to KotLC Chats moderators.\n\n**Your message**:\n\n {msg_content}').set_author(
-                        name=self.embed_details['author name'], icon_url=self.embed_details['author icon'])
+                initiate_modmail_embed = discord.Embed(description=f'Please confirm that you would like to open a modmail and relay your message to KotLC Chats moderators.\n\n**Your message**:\n\n {msg_content}').set_author(
+                    name=self.embed_details['author name'], icon_url=self.embed_details['author icon'])
 
-                    confirm_view = Confirm(message.author)
-                    confirm_view.message = await message.channel.send(embed=initiate_modmail_embed, view=confirm_view)
+                confirm_view = Confirm(message.author)
+                confirm_view.message = await message.channel.send(embed=initiate_modmail_embed, view=confirm_view)
 
+                self.pending_confirmations.inc()
+                wait_started_at = time.perf_counter()
+                try:
                     timed_out = await confirm_view.wait()
+                finally:
+                    self.pending_confirmations.dec()
+                    waited = time.perf_counter() - wait_started_at
+                    self.confirmation_seconds.observe(waited)
 
-                    for child in confirm_view.children:
-                        child.disabled = True
-                    await confirm_view.message.edit(view=confirm_view)
+                for child in confirm_view.children:
+                    child.disabled = True
+                await confirm_view.message.edit(view=confirm_view)
 
-                    if timed_out:
-                        confirm_view = confirm_view
-                        await message.channel.send(embed=self.bot.simple_embed('Timed out; process cancelled. To try again, send a new message.'))
-                        return
+                if timed_out:
+                    await message.channel.send(embed=self.bot.simple_embed('Timed out; process cancelled. To try again, send a new message.'))
+                    return
 
-                    if confirm_view.value is True:  # if user confirms
-                        await message.channel.send(embed=self.bot.simple_embed('Okay, relaying your message to the moderators...'))
-                        # open new modmail
-                        await self.open_modmail_func(message, message.author.id, True)
+                if confirm_view.value is True:  # if user confirms
+                    await message.channel.send(embed=self.bot.simple_embed('Okay, relaying your message to the moderators...'))
+                    # open new modmail
+                    await self.open_modmail_func(message, message.author.id, True)
 
-                    else:  # if user cancels
-                        await message.channel.send(embed=self.bot.simple_embed('Cancelled.'))
+                else:  # if user cancels
+                    await message.channel.send(embed=self.bot.simple_embed('Cancelled.'))
 
         except Exception as error:
             await message.channel.send(embed=self.bot.simple_embed(f'Something went wrong: {error}'))
@@ -257,29 +416,16 @@ class Modmail(commands.Cog):
             print_exception(
                 type(error), error, error.__traceback__, file=stderr)
 
-    @listener_check
-    @commands.Cog.listener(name='on_message')
-    async def guild_modmail_listener(self, message: discord.Message):
-        """Listens for messages in modmail channels and calls relay_message to relay them to the relevant user."""
-
-        try:
-            # ignore DMs (other listener) and guild messages outside modmail cat (reduce db requests)
-            if message.guild is not None and message.channel.category_id == self.bot.modmail_category_id:
+        return waited
 
-                modmail_entry = await self.bot.do_db_query(self.bot, 'SELECT * FROM activemodmails WHERE modmailchnlid=?', (message.channel.id, ), "one")
+    async def guild_modmail_listener(self, message: discord.Message, modmail_entry: tuple):
+        """Handles a message in an active modmail channel by queueing it to be relayed to the relevant user.
 
-                # if in active modmail channel
-                if modmail_entry:
-                    try:
-                        await self.relay_message(message, modmail_entry, False)
-                    except discord.Forbidden as error:
-                        await message.channel.send(embed=self.bot.simple_embed(f"Error: couldn't DM that user. ({error})"))
+        :param message: The message sent in the modmail channel (not a command, not from a bot or a blacklisted user).
+        :param modmail_entry: Row of the modmail attached to the channel.
+        """
 
-        except Exception as error:
-            await message.channel.send(embed=self.bot.simple_embed(f'Something went wrong: {error}'))
-            print('Ignoring exception in on_message listener:', file=stderr)
-            print_exception(
-                type(error), error, error.__traceback__, file=stderr)
+        self.queue_relay(message, modmail_entry, False)
     # endregion
 
     # region modmail commands and errors
@@ -304,7 +450,7 @@ class Modmail(commands.Cog):
         if something goes wrong, contact LonelyPenguin#9931.
         Maximum length of reason is 72 characters."""
 
-        modmail_entry = await self.bot.do_db_query(self.bot, 'SELECT * FROM activemodmails WHERE modmailchnlid=?', (ctx.channel.id,), "one")
+        modmail_entry = self.bot.active_modmails.by_channel(ctx.channel.id)
         if modmail_entry:
             await ctx.send(embed=self.bot.simple_embed('Error: you are currently in a modmail. Run this command in a different channel (for privacy).'), delete_after=5.0)
             await ctx.message.delete(delay=4.75)
@@ -333,71 +479,52 @@ class Modmail(commands.Cog):
         No arguments needed."""
 
         if ctx.guild is None:
-            modmail_entry = await self.bot.do_db_query(self.bot, 'SELECT * FROM activemodmails WHERE userid=?', (ctx.author.id,), "one")
+            modmail_entry = self.bot.active_modmails.by_user(ctx.author.id)
         else:
-            modmail_entry = await self.bot.do_db_query(self.bot, 'SELECT * FROM activemodmails WHERE modmailchnlid=?', (ctx.channel.id,), "one")
+            modmail_entry = self.bot.active_modmails.by_channel(ctx.channel.id)
 
-        logs_channel = self.bot.get_channel(self.bot.logs_channel_id)
-        modmail_channel = self.bot.get_channel(modmail_entry[1])
-        modmail_user = self.bot.get_user(modmail_entry[0])
+        logs_channel = await self.bot.resolver.channel(self.bot.logs_channel_id)
+        try:
+            modmail_channel = await self.bot.resolver.channel(modmail_entry[1])
+        except discord.NotFound:  # deleted by hand; the modmail is still closed, with the log that was recorded
+            modmail_channel = None
+        modmail_user = await self.bot.resolver.user(modmail_entry[0])
         modmail_reason = modmail_entry[2]
 
         await ctx.send(embed=self.bot.simple_embed('Creating logs and closing modmail...'))
 
-        modmail_log = StringIO()
-
-        async for message in modmail_channel.history(limit=None, oldest_first=True):
-
-            reply_if_any = ''
-            if message.reference and message.reference.resolved:
-                reply_if_any = f'Reply to: {message.reference.resolved.id}'
+        # messages still waiting to be relayed belong in the log, and must not be relayed once the channel is gone;
+        # an open burst is ended so nothing more joins it, and is relayed once its window is up
+        self.relay_bursts.pop(modmail_entry[1], None)
+        await self.relay_queues.drain(modmail_entry[1])
 
-            embeds_if_any = ''
-            if message.embeds:
-                embed_desc_list = [fill(
-                    embed.description) for embed in message.embeds]
-                embeds_if_any = '\nEmbed description(s):\n{}\n'.format(
-                    ',\n\n'.join(embed_desc_list))
-
-            attachments_if_any = ''
-            if message.attachments:
-                attachment_url_list = [
-                    attachment.url for attachment in message.attachments]
-                attachments_if_any = '\nAttachment URL(s):\n{}\n'.format(
-                    ',\n'.join(attachment_url_list))
-
-            contentstr = f'Content:\n{fill(message.system_content)}\n' if message.system_content else '[no message content]\n'
-
-            modmail_log.write(
-                f'{message.author.name}#{message.author.discriminator} ({message.author.id}) at {str(message.created_at)[:19]} UTC\n{reply_if_any}\n{contentstr}{embeds_if_any}{attachments_if_any}\n{message.id}\n\n')
-
-        modmail_log.seek(0)
         log_filename = f'log-{modmail_user.name}-{modmail_reason}-{str(ctx.message.created_at)[:10]}.txt'
+        log_files = await self.bot.transcripts.log_files(modmail_entry[1], modmail_channel, log_filename, upload_limit(logs_channel))
 
         # send to moderators' logs:
-        dpy_compatible_log = discord.File(
-            fp=modmail_log, filename=log_filename)
-        modmail_log.close()
-
         mod_modmail_closed_embed = discord.Embed(description=f'Modmail with {modmail_user.mention} closed by {ctx.author.name}. Modmail reason was `{modmail_reason}`.').set_author(
             name=self.embed_details['author name'], icon_url=self.embed_details['author icon']).set_footer(text='Use ;modmail open <user> [reason] to open another modmail.')
 
         await logs_channel.send(embed=mod_modmail_closed_embed)
-        await logs_channel.send(file=dpy_compatible_log)
+        for dpy_compatible_log in log_files:
+            await logs_channel.send(file=dpy_compatible_log)
 
-        await self.bot.do_db_query(self.bot, 'DELETE FROM activemodmails WHERE modmailchnlid=?', (modmail_entry[1],))
+        await self.bot.active_modmails.forget(modmail_entry[1])
 
         # send to the user:
-        dpy_compatible_log = discord.File(
-            fp=modmail_log, filename=log_filename)
-
         # single quotes used despite apostrophes due to double quotes elsewhere in string
         user_modmail_closed_embed = discord.Embed(description=f"Modmail closed by {ctx.author.name}. At time of closure, the modmail's reason was `{modmail_reason}`.").set_author(
             name=self.embed_details['author name'], icon_url=self.embed_details['author icon']).set_footer(text='Send another message to open a new modmail.')
         await modmail_user.send(embed=user_modmail_closed_embed)
 
-        modmail_log.close()
-        await modmail_channel.delete()
+        self.bot.resolver.forget('channel', modmail_entry[1])
+        if modmail_channel is None:
+            await ctx.send(embed=self.bot.simple_embed('Note: Modmail closed, but its channel had already been deleted, so its log only has the messages the bot recorded.'))
+            return
+        try:
+            await modmail_channel.delete()
+        except discord.NotFound:  # deleted by hand while the modmail was being closed
+            pass
 
     @modmail.command(name='reason', aliases=['topic', 'subject'])
     @commands.cooldown(2, 10.0, commands.cooldowns.BucketType.channel)
@@ -412,9 +539,9 @@ class Modmail(commands.Cog):
         if not reason:
 
             if ctx.guild is None:
-                modmail_entry = await self.bot.do_db_query(self.bot, 'SELECT * FROM activemodmails WHERE userid=?', (ctx.author.id,), "one")
+                modmail_entry = self.bot.active_modmails.by_user(ctx.author.id)
             else:
-                modmail_entry = await self.bot.do_db_query(self.bot, 'SELECT * FROM activemodmails WHERE modmailchnlid=?', (ctx.channel.id,), "one")
+                modmail_entry = self.bot.active_modmails.by_channel(ctx.channel.id)
 
             reason = modmail_entry[2]
 
@@ -430,19 +557,36 @@ class Modmail(commands.Cog):
             name=self.embed_details['author name'], icon_url=self.embed_details['author icon']).set_footer(text=self.embed_details['footer'])
 
         if ctx.guild is None:
-            modmail_entry = await self.bot.do_db_query(self.bot, 'SELECT * FROM activemodmails WHERE userid=?', (ctx.author.id,), "one")
+            modmail_entry = self.bot.active_modmails.by_user(ctx.author.id)
         else:
-            modmail_entry = await self.bot.do_db_query(self.bot, 'SELECT * FROM activemodmails WHERE modmailchnlid=?', (ctx.channel.id,), "one")
+            modmail_entry = self.bot.active_modmails.by_channel(ctx.channel.id)
 
-        await self.bot.do_db_query(self.bot, 'UPDATE activemodmails SET reason=? WHERE modmailchnlid=? ', (reason, modmail_entry[1]))
-        modmail_channel = self.bot.get_channel(modmail_entry[1])
-        modmail_user = self.bot.get_user(modmail_entry[0])
+        await self.bot.active_modmails.set_reason(modmail_entry[1], reason)
+        modmail_channel = await self.bot.resolver.channel(modmail_entry[1])
+        modmail_user = await self.bot.resolver.user(modmail_entry[0])
 
         mod_reason_updated_msg = await modmail_channel.send(embed=update_notice_embed)
+        await self.bot.transcripts.append(modmail_entry[1], mod_reason_updated_msg)
         user_reason_updated_msg = await modmail_user.send(embed=update_notice_embed)
         await mod_reason_updated_msg.pin()
         await user_reason_updated_msg.pin()
 
+    @modmail.command(name='queues', aliases=['queue', 'backlog'])
+    @mod_only()
+    @commands.guild_only()
+    async def relay_queue_depths(self, ctx: commands.Context):
+        """Shows how many messages are waiting to be relayed in each modmail.
+        Only modmails that have relayed a message recently are listed.
+        Only moderators can use this command."""
+
+        depths = self.relay_queues.depths()
+        if not depths:
+            await ctx.send(embed=self.bot.simple_embed('No modmail has relayed a message recently.'))
+            return
+
+        depths_str = '\n'.join(f'<#{modmailchnlid}>: {depth}' for modmailchnlid, depth in sorted(depths.items(), key=lambda item: item[1], reverse=True))
+        await ctx.send(embed=self.bot.simple_embed(f'Messages waiting to be relayed, per modmail:\n\n{depths_str}'))
+
     @modmail.error
     async def modmail_error(self, ctx: commands.Context, error):
         if isinstance(error, commands.CommandInvokeError):
@@ -454,6 +598,8 @@ class Modmail(commands.Cog):
             error = error.original
         if isinstance(error, discord.Forbidden) or isinstance(error, AttributeError):
             await ctx.send(embed=self.bot.simple_embed(f"Error: bot probably can't DM that user. ({error})"))
+        elif isinstance(error, discord.NotFound):
+            await ctx.send(embed=self.bot.simple_embed(f"Error: couldn't find that user or the modmail category; it may have been deleted. ({error})"))
         elif isinstance(error, asyncio.TimeoutError):
             await ctx.send(embed=self.bot.simple_embed(f'Timed out. Use the command `;modmail open <user> [reason]` to try again. ({error})'))
         elif isinstance(error, commands.MissingRequiredArgument):
@@ -485,6 +631,8 @@ class Modmail(commands.Cog):
         if isinstance(error, TypeError):
             await ctx.send(embed=self.bot.simple_embed(f"Error: You probably aren't in a modmail. ({error})"), delete_after=5.0)
             await ctx.message.delete(delay=4.75)
+        elif isinstance(error, discord.NotFound):
+            await ctx.send(embed=self.bot.simple_embed(f"Error: This modmail's user or the logs channel no longer exists, so the modmail wasn't closed. ({error})"))
         elif isinstance(error, discord.HTTPException):
             if error.code == 50035:
                 await ctx.send(embed=self.bot.simple_embed(f'Error: Reason is too long– change the reason to a shorter one, then close the modmail. ({error})'))
@@ -502,6 +650,22 @@ class Modmail(commands.Cog):
             print_exception(
                 type(error), error, error.__traceback__, file=stderr)
 
+    @relay_queue_depths.error
+    async def relay_queue_depths_error(self, ctx: commands.Context, error):
+        if isinstance(error, commands.CommandInvokeError):
+            error = error.original
+        if isinstance(error, commands.NoPrivateMessage):
+            await ctx.send(embed=self.bot.simple_embed('Error: command cannot be used in DMs.'))
+        elif isinstance(error, commands.CheckFailure):
+            await ctx.send(embed=self.bot.simple_embed('You may not use this command.'))
+        else:
+            # All other errors not returned come here. And we can just print the default Traceback.
+            await ctx.send(embed=self.bot.simple_embed(f'Something went wrong: {error}'))
+            print('Ignoring exception in command {}:'.format(
+                ctx.command), file=stderr)
+            print_exception(
+                type(error), error, error.__traceback__, file=stderr)
+
     @modmailreason.error
     async def modmailreason_error(self, ctx: commands.Context, error):
         if isinstance(error, commands.CommandInvokeError):
@@ -509,6 +673,8 @@ class Modmail(commands.Cog):
         if isinstance(error, TypeError):
             await ctx.send(embed=self.bot.simple_embed(f"Error: You probably aren't in a modmail. ({error})"), delete_after=5.0)
             await ctx.message.delete(delay=4.75)
+        elif isinstance(error, discord.NotFound):
+            await ctx.send(embed=self.bot.simple_embed(f"Error: This modmail's channel or user no longer exists. The reason was still changed; use `;modmail close` to close the modmail. ({error})"))
         elif isinstance(error, discord.HTTPException):
             if error.code == 50035:
                 await ctx.send(embed=self.bot.simple_embed(f'Error: Reason is too long– please use this command again with a shorter reason. ({error})'))
@@ -0,0 +1,94 @@
+import gzip
+import logging
+import os
+import shutil
+import time
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from queue import SimpleQueue
+
+
+LOG_FORMAT = '%(asctime)s:%(levelname)s:%(name)s: %(message)s'
+
+
+class CompressingRotatingFileHandler(RotatingFileHandler):
+    """A log file that is rotated once it reaches max_bytes or is max_age seconds old, whichever comes first.
+
+    Rotated files are gzipped (`discord.log.1.gz`, `discord.log.2.gz`, ...), and the oldest beyond backup_count are
+    deleted. Only ever written to from the QueueListener's thread, so rotating and compressing never block the bot.
+    """
+
+    def __init__(self, filename: str, max_bytes: int = 10 * 1024 ** 2, max_age: float = 24 * 60 * 60, backup_count: int = 5):
+        super().__init__(filename, mode='a', maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8', delay=True)
+        self.max_age = max_age
+        self.rollover_at = self._first_rollover_time()
+
+    def _first_rollover_time(self):
+        # a file left over from the last run keeps its age, so restarting often doesn't stop it from being rotated
+        try:
+            return os.stat(self.baseFilename).st_mtime + self.max_age if os.path.getsize(self.baseFilename) else time.time() + self.max_age
+        except OSError:
+            return time.time() + self.max_age
+
+    def rotation_filename(self, default_name: str):
+        return f'{default_name}.gz'
+
+    def rotate(self, source: str, dest: str):
+        with open(source, 'rb') as source_file, gzip.open(dest, 'wb') as dest_file:
+            shutil.copyfileobj(source_file, dest_file)
+        os.remove(source)
+
+    def shouldRollover(self, record):
+        if self.max_age and time.time() >= self.rollover_at:
+            return True
+        return super().shouldRollover(record)
+
+    def doRollover(self):
+        super().doRollover()
+        self.rollover_at = time.time() + self.max_age
+
+
+# arguments of these types can be changed after they are logged (discord.py goes on to modify gateway payload dicts)
+MUTABLE_ARG_TYPES = (dict, list, set, bytearray)
+
+
+class UnformattedQueueHandler(QueueHandler):
+    """Puts log records on the queue as they are, leaving them to be formatted by the listener's handler.
+
+    QueueHandler.prepare formats each record (running getMessage, which builds the message from its arguments) before
+    queueing it, on whichever thread logged it; for the bot that is the event loop, and at DEBUG, with every gateway
+    payload. Records never leave this process, so they don't need to be made picklable first.
+
+    A record whose arguments include a mutable container is the exception: by the time the listener formats it, the
+    container may have been changed (or be changing in the middle of being formatted), so its message is built here.
+    """
+
+    def prepare(self, record):
+        args = record.args
+        if isinstance(args, MUTABLE_ARG_TYPES) or (isinstance(args, tuple) and any(isinstance(arg, MUTABLE_ARG_TYPES) for arg in args)):
+            record.msg = record.getMessage()
+            record.args = None
+        return record
+
+
+def setup_logging(filename: str = 'discord.log', level: str = 'INFO', max_bytes: int = 10 * 1024 ** 2, max_age: float = 24 * 60 * 60, backup_count: int = 5):
+    """Send the discord logger's records through a queue to a file written by a background thread.
+
+    Logging from the event loop then only costs putting the record on the queue (see UnformattedQueueHandler);
+    building the message, formatting the line, writing it out and rotating the file all happen in the listener's thread.
+
+    :param level: Level of the discord logger. Can be changed at runtime with `;admin loglevel`.
+    :return: The started QueueListener. Call its stop() on shutdown to flush what's left in the queue.
+    """
+
+    file_handler = CompressingRotatingFileHandler(filename, max_bytes=max_bytes, max_age=max_age, backup_count=backup_count)
+    file_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+
+    log_queue = SimpleQueue()
+    listener = QueueListener(log_queue, file_handler, respect_handler_level=True)
+
+    logger = logging.getLogger('discord')
+    logger.setLevel(level.upper())
+    logger.addHandler(UnformattedQueueHandler(log_queue))
+
+    listener.start()
+    return listener
@@ -0,0 +1,92 @@
+import asyncio
+import sys
+import threading
+import time
+import traceback
+from sys import stderr
+
+from discord.ext import commands
+
+
+class LoopWatchdog:
+    """Notices when something blocks the event loop, and catches it in the act.
+
+    A heartbeat task on the loop wakes up every interval seconds; how late it wakes up is the loop's lag, recorded in
+    the metrics. A watchdog thread checks on the heartbeat, and if it has been silent for longer than threshold
+    seconds, the loop is stalled: the watchdog grabs the loop thread's stack right then, which shows the code that is
+    blocking it. Once the loop recovers, the stall is counted in the metrics and reported to the logs channel
+    (at most once per report_cooldown seconds; the rest are printed).
+    """
+
+    def __init__(self, bot: commands.Bot, threshold: float = 0.5, interval: float = 0.1, report_cooldown: float = 60.0):
+        self.bot = bot
+        self.threshold = threshold
+        self.interval = interval
+        self.report_cooldown = report_cooldown
+
+        self.lag_seconds = bot.metrics.histogram('event_loop_lag_seconds', 'How late the event loop ran a callback that was due.', (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0))
+        self.stall_seconds = bot.metrics.histogram('event_loop_stall_seconds', 'How long each stall of the event loop lasted.', (0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0))
+
+        self._last_beat = time.monotonic()
+        self._stall_stack = None  # loop thread's stack, captured by the watchdog during the current stall
+        self._last_report = 0.0
+        self._loop_thread_id = None
+        self._heartbeat_task = None
+        self._report_tasks = set()
+        self._stopping = threading.Event()
+
+    def start(self):
+        """Start the heartbeat and the watchdog thread. Must be called from the event loop."""
+
+        self._loop_thread_id = threading.get_ident()
+        self._last_beat = time.monotonic()
+        self._heartbeat_task = asyncio.create_task(self._heartbeat())
+        threading.Thread(target=self._watch, name='loop-watchdog', daemon=True).start()
+
+    def stop(self):
+        self._stopping.set()
+        if self._heartbeat_task is not None:
+            self._heartbeat_task.cancel()
+        for task in self._report_tasks:
+            task.cancel()
+
+    async def _heartbeat(self):
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            lag = now - expected
+            self.lag_seconds.observe(max(lag, 0.0))
+
+            # the beat is recorded first, so the watchdog can't mistake the next few lines for a stall
+            self._last_beat = now
+            stall_stack, self._stall_stack = self._stall_stack, None
+            if stall_stack is not None:
+                # reported in a task of its own, so a slow send to the logs channel doesn't hold up the next beat
+                # (and get caught as a stall itself)
+                task = asyncio.create_task(self._report(lag + self.interval, stall_stack))
+                self._report_tasks.add(task)
+                task.add_done_callback(self._report_tasks.discard)
+
+    def _watch(self):
+        while not self._stopping.wait(self.interval / 2):
+            if self._stall_stack is None and time.monotonic() - self._last_beat > self.threshold:
+                frame = sys._current_frames().get(self._loop_thread_id)
+                if frame is not None:
+                    self._stall_stack = ''.join(traceback.format_stack(frame))
+
+    async def _report(self, duration: float, stack: str):
+        self.stall_seconds.observe(duration)
+        print(f'Event loop was blocked for {duration:.2f}s in:\n{stack}', file=stderr)
+
+        logs_channel = self.bot.get_channel(self.bot.logs_channel_id)
+        if logs_channel is None or time.monotonic() - self._last_report < self.report_cooldown:
+            return
+        self._last_report = time.monotonic()
+
+        # keep the innermost frames, which is where the blocking call is
+        stack = stack[-3900:]
+        try:
+            await logs_channel.send(embed=self.bot.simple_embed(f'**The bot was frozen for {duration:.2f}s.** It was running:\n```\n{stack}\n```'))
+        except Exception as error:
+            print(f'Could not report an event loop stall to the logs channel: {error!r}', file=stderr)
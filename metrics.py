@@ -0,0 +1,245 @@
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from sys import stderr
+
+from aiohttp import web
+
+
+# upper bounds of the latency histograms, in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _label_str(labels: tuple):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in labels) + '}'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Counter:
+    """A value that only goes up, e.g. the number of messages relayed."""
+
+    kind = 'counter'
+
+    def __init__(self, name: str, description: str):
+        self.name = name
+        self.description = description
+        self.values = {}  # sorted (label, value) tuples -> count
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def total(self):
+        return sum(self.values.values())
+
+    def render(self):
+        return [f'{self.name}{_label_str(labels)} {value}' for labels, value in self.values.items()]
+
+
+class Gauge:
+    """A value that can go up and down, e.g. the number of active modmails.
+
+    If given a function, the gauge reads its value from it whenever it is scraped instead.
+    """
+
+    kind = 'gauge'
+
+    def __init__(self, name: str, description: str, function=None):
+        self.name = name
+        self.description = description
+        self.function = function
+        self.value = 0
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+    def dec(self, amount: float = 1):
+        self.value -= amount
+
+    def set(self, value: float):
+        self.value = value
+
+    def get(self):
+        return self.function() if self.function is not None else self.value
+
+    def render(self):
+        return [f'{self.name} {self.get()}']
+
+
+class Histogram:
+    """Counts observations (usually durations, in seconds) into buckets, so their distribution can be estimated."""
+
+    kind = 'histogram'
+
+    def __init__(self, name: str, description: str, buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.buckets = tuple(buckets)
+        self.values = {}  # sorted (label, value) tuples -> [bucket counts..., +Inf count, sum]
+
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        counts = self.values.get(key)
+        if counts is None:
+            counts = self.values[key] = [0] * (len(self.buckets) + 2)
+        counts[bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe how long the body of a `with` block takes, even if it raises."""
+
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started_at, **labels)
+
+    def _merged(self, **labels):
+        """Bucket counts and sum across every label set matching the given labels."""
+
+        merged = [0] * (len(self.buckets) + 2)
+        wanted = set(labels.items())
+        for key, counts in self.values.items():
+            if wanted <= set(key):
+                merged = [a + b for a, b in zip(merged, counts)]
+        return merged
+
+    def count(self, **labels):
+        return sum(self._merged(**labels)[:-1])
+
+    def mean(self, **labels):
+        merged = self._merged(**labels)
+        count = sum(merged[:-1])
+        return merged[-1] / count if count else 0.0
+
+    def quantile(self, q: float, **labels):
+        """Estimate a quantile by interpolating within its bucket, the way Prometheus' histogram_quantile does."""
+
+        merged = self._merged(**labels)[:-1]
+        count = sum(merged)
+        if not count:
+            return 0.0
+
+        rank = q * count
+        seen = 0
+        for index, bucket_count in enumerate(merged):
+            if seen + bucket_count >= rank and bucket_count:
+                if index == len(self.buckets):  # past the last bucket; the best we can say is "more than that"
+                    return self.buckets[-1]
+                lower = self.buckets[index - 1] if index else 0.0
+                return lower + (self.buckets[index] - lower) * (rank - seen) / bucket_count
+            seen += bucket_count
+        return self.buckets[-1]
+
+    def render(self):
+        lines = []
+        for labels, counts in self.values.items():
+            cumulative = 0
+            for bound, bucket_count in zip((*self.buckets, '+Inf'), counts[:-1]):
+                cumulative += bucket_count
+                lines.append(f'{self.name}_bucket{_label_str(labels + (("le", bound),))} {cumulative}')
+            lines.append(f'{self.name}_sum{_label_str(labels)} {counts[-1]}')
+            lines.append(f'{self.name}_count{_label_str(labels)} {cumulative}')
+        return lines
+
+
+class Metrics:
+    """The bot's metrics, and the local HTTP endpoint that serves them in the Prometheus text format.
+
+    Metrics are created once, by name, through counter(), gauge() and histogram(); asking for a name again returns the
+    same metric, so cogs can be reloaded without losing counts.
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._runner = None
+        self.started_at = time.monotonic()
+
+    def _get_or_create(self, cls, name: str, *args, **kwargs):
+        metric = self._metrics.get(name)
+        if metric is None:
+            metric = self._metrics[name] = cls(name, *args, **kwargs)
+        return metric
+
+    def counter(self, name: str, description: str):
+        return self._get_or_create(Counter, name, description)
+
+    def gauge(self, name: str, description: str, function=None):
+        gauge = self._get_or_create(Gauge, name, description)
+        if function is not None:
+            gauge.function = function
+        return gauge
+
+    def histogram(self, name: str, description: str, buckets: tuple = DEFAULT_BUCKETS):
+        return self._get_or_create(Histogram, name, description, buckets)
+
+    def get(self, name: str):
+        return self._metrics.get(name)
+
+    def render(self):
+        """Return every metric in the Prometheus text exposition format."""
+
+        lines = []
+        for metric in self._metrics.values():
+            lines.append(f'# HELP {metric.name} {metric.description}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+    # region HTTP endpoint
+    async def serve(self, host: str = '127.0.0.1', port: int = 9108):
+        """Start serving the metrics on http://host:port/metrics.
+
+        If the port can't be bound (e.g. another instance still has it during a deploy), the bot keeps running without
+        the endpoint; ;stats still works.
+        """
+
+        async def handle_metrics(request):
+            return web.Response(text=self.render(), content_type='text/plain', charset='utf-8', headers={'X-Content-Type-Options': 'nosniff'})
+
+        app = web.Application()
+        app.router.add_get('/metrics', handle_metrics)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        try:
+            await web.TCPSite(self._runner, host, port).start()
+        except OSError as error:
+            print(f'Could not serve metrics on http://{host}:{port}/metrics, continuing without the endpoint: {error!r}', file=stderr)
+            await self._runner.cleanup()
+            self._runner = None
+            return
+        print(f'Serving metrics on http://{host}:{port}/metrics')
+
+    async def close(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+    # endregion
+
+
+def instrument_http(http, metrics: Metrics):
+    """Time every Discord REST call made through a discord.py HTTPClient.
+
+    Calls are labelled with their method and route template (e.g. `/channels/{channel_id}/messages`), not the actual
+    path, so that the number of label sets stays small.
+    """
+
+    requests = metrics.histogram('discord_rest_request_seconds', 'Time taken by Discord REST calls, including rate limit waits.')
+    errors = metrics.counter('discord_rest_errors_total', 'Discord REST calls that raised, by HTTP status.')
+    original_request = http.request
+
+    async def request(route, **kwargs):
+        with requests.time(method=route.method, route=route.path):
+            try:
+                return await original_request(route, **kwargs)
+            except Exception as error:
+                errors.inc(method=route.method, route=route.path, status=getattr(error, 'status', type(error).__name__))
+                raise
+
+    http.request = request
@@ -0,0 +1,53 @@
+from discord.ext import commands
+
+
+class ModeratorRegistry:
+    """The bot's moderators, kept in the moderators table and mirrored in the access policy's in-memory set.
+
+    Every change is written through to the database first (in one transaction, however many users it covers), then
+    applied to the set, and then announced with a `moderators_update` event, so any cog can react to it with
+    `@commands.Cog.listener()` `async def on_moderators_update(self, added, removed)`.
+    """
+
+    def __init__(self, bot: commands.Bot):
+        self.bot = bot
+
+    def __iter__(self):
+        return iter(sorted(self.bot.access_policy.moderator_ids))
+
+    def __len__(self):
+        return len(self.bot.access_policy.moderator_ids)
+
+    def __contains__(self, user_id: int):
+        # only the registry itself: members who are moderators through a role aren't in it
+        return user_id in self.bot.access_policy.moderator_ids
+
+    async def load(self, seed_ids=()):
+        """Load the moderators into the access policy. Called once at startup.
+
+        :param seed_ids: Moderators to add first; used to fill the table from server_vars.json when it is first created.
+        """
+
+        if seed_ids:
+            await self.bot.storage.add_moderators(list(seed_ids))
+        self.bot.access_policy.set_moderators(await self.bot.storage.get_moderators())
+
+    async def add(self, user_ids):
+        """Add users to the registry. Returns the ones that weren't in it already."""
+
+        added = sorted({user_id for user_id in user_ids if user_id not in self})
+        if added:
+            await self.bot.storage.add_moderators(added)
+            self.bot.access_policy.add_moderators(added)
+            self.bot.dispatch('moderators_update', added, [])
+        return added
+
+    async def remove(self, user_ids):
+        """Remove users from the registry. Returns the ones that were in it."""
+
+        removed = sorted({user_id for user_id in user_ids if user_id in self})
+        if removed:
+            await self.bot.storage.remove_moderators(removed)
+            self.bot.access_policy.remove_moderators(removed)
+            self.bot.dispatch('moderators_update', [], removed)
+        return removed
@@ -0,0 +1,99 @@
+from discord.ext import commands
+
+
+class ActiveModmails:
+    """In-memory index of the activemodmails table, so that routing a message never needs a database round trip.
+
+    Rows are kept as `(userid, modmailchnlid, reason)` tuples (the same shape as the database rows) and can be looked up
+    by either the user's ID or the modmail channel's ID.
+    Every change is written through to the database first, and only then applied to the index.
+    """
+
+    def __init__(self, bot: commands.Bot):
+        self.bot = bot
+        self._by_user = {}
+        self._by_channel = {}
+
+    def __len__(self):
+        return len(self._by_channel)
+
+    def __iter__(self):
+        return iter(list(self._by_channel.values()))
+
+    async def load(self):
+        """(Re)build the index from the database. Called once at startup."""
+
+        rows = await self.bot.storage.get_active_modmails()
+
+        self._by_user.clear()
+        self._by_channel.clear()
+        for row in rows:
+            self._index(tuple(row))
+
+    def _index(self, row: tuple):
+        self._by_channel[row[1]] = row
+        # like fetchone(), the first row found for a user wins if the table has duplicates
+        self._by_user.setdefault(row[0], row)
+
+    def _unindex(self, row: tuple):
+        self._by_channel.pop(row[1], None)
+        if self._by_user.get(row[0]) == row:
+            del self._by_user[row[0]]
+            # fall back to any other (duplicate) row still attached to this user
+            for other_row in self._by_channel.values():
+                if other_row[0] == row[0]:
+                    self._by_user[row[0]] = other_row
+                    break
+
+    def by_user(self, userid: int):
+        """Return the row of the modmail attached to a user, or None."""
+        return self._by_user.get(userid)
+
+    def by_channel(self, modmailchnlid: int):
+        """Return the row of the modmail attached to a channel, or None."""
+        return self._by_channel.get(modmailchnlid)
+
+    async def add(self, userid: int, modmailchnlid: int, reason: str):
+        """Register a new active modmail and return its row."""
+
+        row = (userid, modmailchnlid, reason)
+        await self.bot.storage.add_active_modmail(*row)
+        self._index(row)
+        return row
+
+    async def set_reason(self, modmailchnlid: int, reason: str):
+        """Change the reason of the modmail attached to a channel and return the updated row."""
+
+        await self.bot.storage.set_modmail_reason(modmailchnlid, reason)
+
+        old_row = self._by_channel[modmailchnlid]
+        new_row = (old_row[0], old_row[1], reason)
+        self._by_channel[modmailchnlid] = new_row
+        if self._by_user.get(old_row[0]) == old_row:
+            self._by_user[old_row[0]] = new_row
+        return new_row
+
+    async def remove(self, modmailchnlid: int):
+        """Forget the modmail attached to a channel."""
+
+        await self.bot.storage.remove_active_modmail(modmailchnlid)
+
+        row = self._by_channel.get(modmailchnlid)
+        if row is not None:
+            self._unindex(row)
+
+    async def forget(self, modmailchnlid: int):
+        """Forget a closed modmail along with everything recorded about it: relayed messages, archived attachments and its transcript."""
+
+        await self.remove(modmailchnlid)
+        await self.bot.storage.remove_relayed_messages(modmailchnlid)
+        await self.bot.attachment_archive.forget_modmail(modmailchnlid)
+        await self.bot.transcripts.forget(modmailchnlid)
+
+    async def remove_user(self, userid: int):
+        """Forget every modmail (including duplicates) attached to a user."""
+
+        await self.bot.storage.remove_user_modmails(userid)
+
+        for row in [row for row in self._by_channel.values() if row[0] == userid]:
+            self._unindex(row)
@@ -0,0 +1,66 @@
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+
+class StackSampler:
+    """Statistical profiler: samples the stack of every thread (including the event loop's) at a fixed interval.
+
+    Nothing runs between profiles; sampling happens in its own thread only while sample() is running, so the cost
+    of having it available is nil. Results are kept as collapsed stacks (`frame;frame;frame count`), the input format of
+    flamegraph.pl and speedscope.
+    """
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.stacks = Counter()  # collapsed stack -> number of samples
+        self.samples = 0
+
+    @staticmethod
+    def _frame_name(frame):
+        code = frame.f_code
+        return f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+
+    def sample(self, seconds: float):
+        """Sample every other thread for the given number of seconds. Blocking, so run it in its own thread."""
+
+        own_thread = threading.get_ident()
+        deadline = time.perf_counter() + seconds
+
+        while time.perf_counter() < deadline:
+            thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_thread:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(self._frame_name(frame))
+                    frame = frame.f_back
+                stack.append(thread_names.get(thread_id, str(thread_id)))
+                self.stacks[';'.join(reversed(stack))] += 1
+            self.samples += 1
+            time.sleep(self.interval)
+
+    def collapsed(self):
+        """Return the samples as collapsed stacks, one per line."""
+        return ''.join(f'{stack} {count}\n' for stack, count in self.stacks.most_common())
+
+    def top(self, count: int = 15, thread_name: str = None):
+        """Return the hottest functions as two lists of (function, samples): by own time, and by time including callees.
+
+        :param thread_name: Only count samples from the thread with this name (e.g. 'MainThread', the event loop).
+        """
+
+        own = Counter()
+        inclusive = Counter()
+        for stack, samples in self.stacks.items():
+            frames = stack.split(';')
+            if thread_name is not None and frames[0] != thread_name:
+                continue
+            if len(frames) > 1:
+                own[frames[-1]] += samples
+            for frame in set(frames[1:]):
+                inclusive[frame] += samples
+        return own.most_common(count), inclusive.most_common(count)
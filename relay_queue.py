@@ -0,0 +1,94 @@
+import asyncio
+from sys import stderr
+from traceback import print_exception
+
+
+class RelayQueues:
+    """Per-modmail relay queues, so messages are delivered in the order they were sent.
+
+    Each active modmail gets its own queue and worker task, started on its first relay and torn down once it has sat
+    idle for idle_timeout seconds. Jobs in one modmail run strictly one after another, while different modmails are
+    relayed in parallel, up to max_concurrent jobs at a time. A job can be held back until a given time (see submit_at);
+    it waits without taking one of those slots.
+    """
+
+    def __init__(self, idle_timeout: float = 60.0, max_concurrent: int = 16):
+        self.idle_timeout = idle_timeout
+        self._slots = asyncio.Semaphore(max_concurrent)
+        self._queues = {}  # modmail channel ID -> asyncio.Queue of (coroutine function, args, future, loop time to start at)
+        self._workers = {}  # modmail channel ID -> worker task
+        self._running = set()  # modmail channel IDs with a job currently in progress
+
+    def submit(self, modmailchnlid: int, job, *args):
+        """Queue `job(*args)` to run after everything already queued for the same modmail.
+
+        :param modmailchnlid: Channel ID of the modmail the job belongs to.
+        :param job: Coroutine function to run.
+        :return: Future resolved with the job's result once it has run. Awaiting it is optional.
+        """
+        return self.submit_at(None, modmailchnlid, job, *args)
+
+    def submit_at(self, when: float, modmailchnlid: int, job, *args):
+        """Like submit, but the job doesn't start before `when` (in event loop time), or straight away if it is None.
+
+        Jobs queued after it for the same modmail wait for it as usual.
+        """
+
+        queue = self._queues.get(modmailchnlid)
+        if queue is None:
+            queue = self._queues[modmailchnlid] = asyncio.Queue()
+            self._workers[modmailchnlid] = asyncio.create_task(self._work(modmailchnlid, queue))
+
+        future = asyncio.get_running_loop().create_future()
+        queue.put_nowait((job, args, future, when))
+        return future
+
+    async def drain(self, modmailchnlid: int):
+        """Wait until everything queued so far for a modmail has run."""
+
+        if modmailchnlid in self._queues:
+            await self.submit(modmailchnlid, asyncio.sleep, 0)
+
+    def depths(self):
+        """Return a dict of modmail channel ID -> number of jobs waiting or in progress, for every active worker."""
+        return {modmailchnlid: queue.qsize() + (modmailchnlid in self._running) for modmailchnlid, queue in self._queues.items()}
+
+    async def _work(self, modmailchnlid: int, queue: asyncio.Queue):
+        while True:
+            try:
+                job, args, future, when = await asyncio.wait_for(queue.get(), timeout=self.idle_timeout)
+            except asyncio.TimeoutError:
+                # a job put in the same loop iteration as the timeout is still in the queue, so check before dropping it;
+                # after this check, nothing can be queued before the queue is dropped
+                if not queue.empty():
+                    continue
+                del self._queues[modmailchnlid]
+                del self._workers[modmailchnlid]
+                return
+
+            self._running.add(modmailchnlid)
+            try:
+                if when is not None:
+                    await asyncio.sleep(when - asyncio.get_running_loop().time())
+                async with self._slots:
+                    result = await job(*args)
+            except Exception as error:
+                print(f'Ignoring exception in relay worker for modmail {modmailchnlid}:', file=stderr)
+                print_exception(type(error), error, error.__traceback__, file=stderr)
+                if not future.done():
+                    future.set_exception(error)
+                    future.exception()  # mark as retrieved, in case nobody awaits it
+            else:
+                if not future.done():
+                    future.set_result(result)
+            finally:
+                self._running.discard(modmailchnlid)
+
+    async def close(self):
+        """Stop every worker. Jobs that haven't run yet are dropped."""
+
+        for worker in self._workers.values():
+            worker.cancel()
+        await asyncio.gather(*self._workers.values(), return_exceptions=True)
+        self._queues.clear()
+        self._workers.clear()
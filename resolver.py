@@ -0,0 +1,91 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+from discord.ext import commands
+
+
+class Resolver:
+    """Turns user and channel IDs into discord.py objects, even when the bot doesn't have them cached.
+
+    discord.py only caches what it has seen through the gateway, and in low-memory mode (see `low_memory_mode` in
+    server_vars.json) that is little more than the people who have messaged the bot since it started. A lookup tries,
+    in order:
+
+    1. the gateway cache (bot.get_user / bot.get_channel), which is always up to date;
+    2. the resolver's own cache of objects it fetched, an LRU of at most max_size entries that each expire after
+       ttl seconds, so renamed users and deleted channels don't linger;
+    3. a REST fetch. Concurrent lookups of the same ID share a single request.
+
+    Every lookup is counted in the `resolver_lookups_total` metric, by kind and by which of those answered it.
+    """
+
+    def __init__(self, bot: commands.Bot, max_size: int = 256, ttl: float = 600.0):
+        self.bot = bot
+        self.max_size = max_size
+        self.ttl = ttl
+        self._cache = OrderedDict()  # (kind, ID) -> (object, time it expires), least recently used first
+        self._in_flight = {}  # (kind, ID) -> task fetching it
+
+        self.lookups = bot.metrics.counter('resolver_lookups_total', 'User and channel lookups, by kind and by what answered them (gateway, cache, shared, fetched or failed).')
+        bot.metrics.gauge('resolver_cached_objects', 'Users and channels held in the resolver cache.', lambda: len(self._cache))
+
+    async def user(self, user_id: int):
+        """Return the user with this ID.
+
+        :raises discord.NotFound: No user has that ID.
+        """
+        return await self._resolve('user', user_id, self.bot.get_user, self.bot.fetch_user)
+
+    async def channel(self, channel_id: int):
+        """Return the channel (or category) with this ID.
+
+        :raises discord.NotFound: The channel doesn't exist.
+        :raises discord.Forbidden: The bot can't see the channel.
+        """
+        return await self._resolve('channel', channel_id, self.bot.get_channel, self.bot.fetch_channel)
+
+    def forget(self, kind: str, object_id: int):
+        """Drop a cached object, e.g. a channel that has just been deleted."""
+        self._cache.pop((kind, object_id), None)
+
+    async def _resolve(self, kind: str, object_id: int, get, fetch):
+        found = get(object_id)
+        if found is not None:
+            self.lookups.inc(kind=kind, result='gateway')
+            return found
+
+        key = (kind, object_id)
+        cached = self._cache.get(key)
+        if cached is not None:
+            if cached[1] > time.monotonic():
+                self._cache.move_to_end(key)
+                self.lookups.inc(kind=kind, result='cache')
+                return cached[0]
+            del self._cache[key]
+
+        task = self._in_flight.get(key)
+        if task is not None:
+            self.lookups.inc(kind=kind, result='shared')
+        else:
+            task = asyncio.create_task(self._fetch(key, fetch))
+            self._in_flight[key] = task
+            task.add_done_callback(lambda _: self._in_flight.pop(key, None))
+
+        # shielded, so a lookup that is cancelled doesn't cancel the fetch for the others waiting on it
+        return await asyncio.shield(task)
+
+    async def _fetch(self, key: tuple, fetch):
+        kind, object_id = key
+        try:
+            found = await fetch(object_id)
+        except Exception:
+            self.lookups.inc(kind=kind, result='failed')
+            raise
+        self.lookups.inc(kind=kind, result='fetched')
+
+        self._cache[key] = (found, time.monotonic() + self.ttl)
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.max_size:
+            self._cache.popitem(last=False)
+        return found
@@ -0,0 +1,41 @@
+import time
+from contextlib import contextmanager
+
+
+class StartupTimer:
+    """Times each phase of startup, for the report logged once the bot is connected.
+
+    Phases may run at the same time (e.g. logging in while the database is opened), so they can add up to more than
+    the total.
+    """
+
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.phases = {}  # phase name -> seconds it took, in the order the phases finished
+
+    @contextmanager
+    def phase(self, name: str):
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = time.perf_counter() - started_at
+
+    async def timed(self, name: str, awaitable):
+        """Await something as a phase of its own, e.g. one of several gathered together."""
+
+        with self.phase(name):
+            return await awaitable
+
+    def elapsed(self):
+        return time.perf_counter() - self.started_at
+
+    def report(self):
+        """Return the phases and the total so far as one line each, slowest phases marked."""
+
+        total = self.elapsed()
+        slowest = sorted(self.phases.values(), reverse=True)[:3]
+        width = max((len(name) for name in self.phases), default=0)
+        lines = [f'{name:<{width}} {seconds * 1000:8.1f} ms{" *" if seconds in slowest else ""}' for name, seconds in self.phases.items()]
+        lines.append(f'{"total":<{width}} {total * 1000:8.1f} ms')
+        return '\n'.join(lines)
@@ -0,0 +1,331 @@
+import asyncio
+from contextlib import nullcontext
+from re import search
+from sys import stderr
+
+import aiosqlite
+
+
+# Each migration is a list of statements, run in one transaction. The database's PRAGMA user_version records how many
+# have been applied, so only new ones run at startup. Never edit a migration that has shipped; add a new one instead.
+MIGRATIONS = [
+    # 1: the tables as they were before migrations existed (hence IF NOT EXISTS)
+    [
+        'CREATE TABLE IF NOT EXISTS activemodmails (userid integer, modmailchnlid integer, reason text)',
+        'CREATE TABLE IF NOT EXISTS blacklist (timestamp text, userid integer, username text)',
+        'CREATE TABLE IF NOT EXISTS relayedmessages (sourcemsgid integer, relayedmsgid integer, modmailchnlid integer)',
+        'CREATE INDEX IF NOT EXISTS relayedmessages_source ON relayedmessages (sourcemsgid)',
+        'CREATE INDEX IF NOT EXISTS relayedmessages_relayed ON relayedmessages (relayedmsgid)',
+        'CREATE TABLE IF NOT EXISTS archivedattachments (modmailchnlid integer, messageid integer, filename text, archivename text)',
+        'CREATE TABLE IF NOT EXISTS transcripts (modmailchnlid integer, messageid integer, authorid integer, authorname text, createdat text, replyto integer, content text, embeds text, attachments text)',
+        'CREATE INDEX IF NOT EXISTS transcripts_modmail ON transcripts (modmailchnlid)',
+    ],
+    # 2: one modmail per user and per channel, and indexes for every lookup column
+    [
+        # keep the oldest row of any duplicates; the channels of the others are left for the moderators to clean up
+        'DELETE FROM activemodmails WHERE rowid NOT IN (SELECT MIN(rowid) FROM activemodmails GROUP BY userid)',
+        'DELETE FROM activemodmails WHERE rowid NOT IN (SELECT MIN(rowid) FROM activemodmails GROUP BY modmailchnlid)',
+        'CREATE UNIQUE INDEX activemodmails_userid ON activemodmails (userid)',
+        'CREATE UNIQUE INDEX activemodmails_modmailchnlid ON activemodmails (modmailchnlid)',
+        'CREATE INDEX blacklist_userid ON blacklist (userid)',
+        'CREATE INDEX relayedmessages_modmail ON relayedmessages (modmailchnlid)',
+        'CREATE INDEX archivedattachments_modmail ON archivedattachments (modmailchnlid)',
+    ],
+    # 3: moderators move out of server_vars.json (which only seeds this table, when it is created)
+    [
+        'CREATE TABLE moderators (userid integer PRIMARY KEY)',
+    ],
+    # 4: the first message of transcripts recorded from a modmail's opening, so closing those never reads the channel
+    [
+        'CREATE TABLE transcriptstarts (modmailchnlid integer PRIMARY KEY, messageid integer)',
+    ],
+]
+
+
+class ModmailStorage:
+    """The bot's SQLite database.
+
+    The database runs in WAL mode, so reads never wait for a write to commit: they go through a small pool of read-only
+    connections, while all writes go through a single writer connection. Pending migrations are applied when the
+    database is opened. Cogs use the typed methods below rather than writing SQL themselves.
+
+    Writes are group-committed: everything written within commit_delay seconds of the first write is committed in
+    one transaction, so a burst of writes pays for one fsync instead of one each. Writes that must be on disk before
+    the caller carries on (anything that changes who has a modmail or who is blacklisted) are made with durable=True,
+    which waits for the commit; the rest return once queued. flush() commits everything queued so far.
+
+    If given a Metrics object, the time taken by every query and every commit is recorded.
+
+    Use as an async context manager: `async with ModmailStorage('modmail.db') as storage:`.
+    """
+
+    def __init__(self, path: str, read_connections: int = 3, commit_delay: float = 0.005, metrics=None):
+        self.path = path
+        self.read_connections = read_connections
+        self.commit_delay = commit_delay
+
+        self._query_seconds = self._commit_seconds = None
+        if metrics is not None:
+            self._query_seconds = metrics.histogram('db_query_seconds', 'Time taken by database queries, including waiting for a connection.')
+            self._commit_seconds = metrics.histogram('db_commit_seconds', 'Time taken to commit a batch of writes.')
+
+        self._writer = None
+        self._closing = False  # set by close(); writes are refused from then on
+        self._write_lock = asyncio.Lock()
+        self._pending_writes = []  # (query, args, many, durable, future) waiting for the next commit
+        self._commit_task = None
+        self._readers = asyncio.Queue()
+        self._all_readers = []
+        self.applied_migrations = []  # versions of the migrations applied when the database was opened
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def open(self):
+        # transactions are managed by hand (see _commit_pending), so the sqlite3 module mustn't open its own
+        self._writer = await aiosqlite.connect(self.path, isolation_level=None)
+        await self._writer.execute('PRAGMA journal_mode=WAL')
+        # in WAL mode, NORMAL only gives up durability of the very last commits on power loss, never consistency
+        await self._writer.execute('PRAGMA synchronous=NORMAL')
+        await self.migrate()
+
+        # each connection has its own thread, so they can all be opened at once
+        readers = await asyncio.gather(*(aiosqlite.connect(self.path) for _ in range(self.read_connections)))
+        for reader in readers:
+            await reader.execute('PRAGMA query_only=ON')
+            self._all_readers.append(reader)
+            self._readers.put_nowait(reader)
+
+    async def close(self):
+        self._closing = True
+        if self._writer is not None:
+            # writes queued before close() (including any made while an earlier batch was committing) go in before the writer does
+            while self._pending_writes or self._commit_task is not None:
+                await self.flush()
+        for reader in self._all_readers:
+            await reader.close()
+        self._all_readers.clear()
+        if self._writer is not None:
+            await self._writer.close()
+            self._writer = None
+
+    async def migrate(self):
+        """Apply every migration the database hasn't seen yet."""
+
+        async with self._writer.execute('PRAGMA user_version') as c:
+            (version,) = await c.fetchone()
+
+        for new_version, statements in enumerate(MIGRATIONS[version:], start=version + 1):
+            async with self._write_lock:
+                try:
+                    await self._writer.execute('BEGIN')
+                    for statement in statements:
+                        await self._writer.execute(statement)
+                    await self._writer.execute(f'PRAGMA user_version={new_version}')
+                    await self._writer.execute('COMMIT')
+                except Exception:
+                    await self._writer.execute('ROLLBACK')
+                    raise
+            self.applied_migrations.append(new_version)
+            print(f'Applied database migration {new_version}')
+
+    # region low-level access
+    def _timed(self, query: str):
+        """Time a query, labelled with its statement type and table, if metrics are being recorded."""
+
+        if self._query_seconds is None:
+            return nullcontext()
+        table = search(r'(?:FROM|INTO|UPDATE) (\w+)', query)
+        return self._query_seconds.time(statement=query.split(None, 1)[0], table=table.group(1) if table else '')
+
+    async def _read(self, query: str, args: tuple = (), fetch: str = 'all'):
+        with self._timed(query):
+            reader = await self._readers.get()
+            try:
+                async with reader.execute(query, args) as c:
+                    return await c.fetchone() if fetch == 'one' else await c.fetchall()
+            finally:
+                self._readers.put_nowait(reader)
+
+    async def _write(self, query: str, args=(), durable: bool = False, many: bool = False):
+        """Queue a write to be committed together with every other write made within commit_delay seconds.
+
+        :param durable: Wait until the write is committed (raising if it failed). Otherwise, return as soon as it is
+            queued; failures are printed.
+        :param many: Run the statement once for each set of arguments in args.
+        """
+
+        if self._closing:
+            raise RuntimeError(f'The database is closed, so this write was dropped: {query}')
+
+        future = asyncio.get_running_loop().create_future()
+        self._pending_writes.append((query, args, many, durable, future))
+
+        if self._commit_task is None:
+            self._commit_task = asyncio.create_task(self._commit_soon())
+
+        if durable:
+            await future
+
+    async def flush(self):
+        """Commit every queued write now, and wait until that's done."""
+
+        if self._pending_writes:
+            await self._commit_pending()
+        else:  # a batch may still be committing
+            async with self._write_lock:
+                pass
+
+    async def _commit_soon(self):
+        await asyncio.sleep(self.commit_delay)
+        await self._commit_pending()
+
+    async def _commit_pending(self):
+        """Commit every queued write in one transaction. Each write gets a savepoint, so one failing doesn't undo the rest."""
+
+        async with self._write_lock:
+            batch, self._pending_writes = self._pending_writes, []
+            self._commit_task = None  # writes queued from now on go in the next batch
+            if not batch:
+                return
+
+            results = []
+            try:
+                if self._writer is None:
+                    raise RuntimeError('The database is closed')
+                with self._commit_seconds.time() if self._commit_seconds is not None else nullcontext():
+                    await self._writer.execute('BEGIN')
+                    for query, args, many, _, _ in batch:
+                        await self._writer.execute('SAVEPOINT queued_write')
+                        try:
+                            with self._timed(query):
+                                if many:
+                                    await self._writer.executemany(query, args)
+                                else:
+                                    await self._writer.execute(query, args)
+                            results.append(None)
+                        except Exception as error:
+                            await self._writer.execute('ROLLBACK TO queued_write')
+                            results.append(error)
+                        await self._writer.execute('RELEASE queued_write')
+                    await self._writer.execute('COMMIT')
+            except Exception as error:
+                if self._writer is not None and self._writer.in_transaction:
+                    await self._writer.execute('ROLLBACK')
+                results = [error] * len(batch)
+
+        for (query, _, _, durable, future), error in zip(batch, results):
+            if future.done():
+                continue
+            if error is None:
+                future.set_result(None)
+            elif durable:  # raised to the caller
+                future.set_exception(error)
+            else:  # nobody is waiting to hear about it
+                future.set_result(None)
+                print(f'Database write failed ({query}): {error!r}', file=stderr)
+    # endregion
+
+    # region activemodmails
+    async def get_active_modmails(self):
+        return await self._read('SELECT userid, modmailchnlid, reason FROM activemodmails')
+
+    async def get_user_modmails(self, userid: int):
+        return await self._read('SELECT userid, modmailchnlid, reason FROM activemodmails WHERE userid=?', (userid,))
+
+    async def add_active_modmail(self, userid: int, modmailchnlid: int, reason: str):
+        await self._write('INSERT INTO activemodmails VALUES (?,?,?)', (userid, modmailchnlid, reason), durable=True)
+
+    async def set_modmail_reason(self, modmailchnlid: int, reason: str):
+        await self._write('UPDATE activemodmails SET reason=? WHERE modmailchnlid=?', (reason, modmailchnlid), durable=True)
+
+    async def remove_active_modmail(self, modmailchnlid: int):
+        await self._write('DELETE FROM activemodmails WHERE modmailchnlid=?', (modmailchnlid,), durable=True)
+
+    async def remove_user_modmails(self, userid: int):
+        await self._write('DELETE FROM activemodmails WHERE userid=?', (userid,), durable=True)
+    # endregion
+
+    # region blacklist
+    async def get_blacklist(self):
+        """Return every blacklist row as (timestamp, userid, username)."""
+        return await self._read('SELECT timestamp, userid, username FROM blacklist')
+
+    async def add_blacklisted_user(self, timestamp: str, userid: int, username: str):
+        await self._write('INSERT INTO blacklist VALUES (?,?,?)', (timestamp, userid, username), durable=True)
+
+    async def remove_blacklisted_user(self, userid: int):
+        await self._write('DELETE FROM blacklist WHERE userid=?', (userid,), durable=True)
+    # endregion
+
+    # region moderators
+    async def get_moderators(self):
+        return [row[0] for row in await self._read('SELECT userid FROM moderators')]
+
+    async def add_moderators(self, userids: list):
+        """Add several moderators at once. All of them are added or, if anything fails, none are."""
+        await self._write('INSERT OR IGNORE INTO moderators VALUES (?)', [(userid,) for userid in userids], durable=True, many=True)
+
+    async def remove_moderators(self, userids: list):
+        """Remove several moderators at once. All of them are removed or, if anything fails, none are."""
+        await self._write('DELETE FROM moderators WHERE userid=?', [(userid,) for userid in userids], durable=True, many=True)
+    # endregion
+
+    # region relayedmessages
+    async def add_relayed_messages(self, source_message_ids: list, relayed_message_id: int, modmailchnlid: int):
+        """Record that one or more messages were relayed as relayed_message_id."""
+        await self._write('INSERT INTO relayedmessages VALUES (?,?,?)', [(source_id, relayed_message_id, modmailchnlid) for source_id in source_message_ids], many=True)
+
+    async def get_relayed_counterpart(self, message_id: int):
+        """Return the ID of the relayed copy of a message, or of the original if it is itself a relayed copy, or None."""
+
+        row = await self._read('SELECT relayedmsgid FROM relayedmessages WHERE sourcemsgid=? UNION ALL SELECT sourcemsgid FROM relayedmessages WHERE relayedmsgid=?', (message_id, message_id), 'one')
+        return row[0] if row else None
+
+    async def get_relayed_source(self, relayed_message_id: int):
+        """Return the ID of the original of a relayed copy, or None if the message isn't a relayed copy."""
+
+        row = await self._read('SELECT sourcemsgid FROM relayedmessages WHERE relayedmsgid=?', (relayed_message_id,), 'one')
+        return row[0] if row else None
+
+    async def remove_relayed_messages(self, modmailchnlid: int):
+        await self._write('DELETE FROM relayedmessages WHERE modmailchnlid=?', (modmailchnlid,))
+    # endregion
+
+    # region archivedattachments
+    async def add_archived_attachment(self, modmailchnlid: int, message_id: int, filename: str, archive_name: str):
+        await self._write('INSERT INTO archivedattachments VALUES (?,?,?,?)', (modmailchnlid, message_id, filename, archive_name))
+
+    async def get_archived_attachments(self, modmailchnlid: int):
+        """Return every attachment archived for a modmail as (messageid, filename, archivename)."""
+        return await self._read('SELECT messageid, filename, archivename FROM archivedattachments WHERE modmailchnlid=?', (modmailchnlid,))
+
+    async def remove_archived_attachments(self, modmailchnlid: int):
+        await self._write('DELETE FROM archivedattachments WHERE modmailchnlid=?', (modmailchnlid,))
+    # endregion
+
+    # region transcripts
+    async def add_transcript_entry(self, modmailchnlid: int, messageid: int, authorid: int, authorname: str, createdat: str, replyto: int, content: str, embeds: str, attachments: str):
+        await self._write('INSERT INTO transcripts VALUES (?,?,?,?,?,?,?,?,?)', (modmailchnlid, messageid, authorid, authorname, createdat, replyto, content, embeds, attachments))
+
+    async def get_transcript(self, modmailchnlid: int):
+        """Return a modmail's transcript rows, oldest first, as (messageid, authorid, authorname, createdat, replyto, content, embeds, attachments)."""
+        return await self._read('SELECT messageid, authorid, authorname, createdat, replyto, content, embeds, attachments FROM transcripts WHERE modmailchnlid=? ORDER BY rowid', (modmailchnlid,))
+
+    async def remove_transcript(self, modmailchnlid: int):
+        await self._write('DELETE FROM transcripts WHERE modmailchnlid=?', (modmailchnlid,))
+        await self._write('DELETE FROM transcriptstarts WHERE modmailchnlid=?', (modmailchnlid,))
+
+    async def add_transcript_start(self, modmailchnlid: int, messageid: int):
+        await self._write('INSERT OR REPLACE INTO transcriptstarts VALUES (?,?)', (modmailchnlid, messageid))
+
+    async def get_transcript_start(self, modmailchnlid: int):
+        """Return the ID of the opening message of a modmail recorded from its opening, or None."""
+
+        row = await self._read('SELECT messageid FROM transcriptstarts WHERE modmailchnlid=?', (modmailchnlid,), 'one')
+        return row[0] if row else None
+    # endregion
@@ -0,0 +1,283 @@
+import asyncio
+import json
+import re
+from gzip import GzipFile
+from tempfile import SpooledTemporaryFile
+from textwrap import fill
+from typing import NamedTuple
+
+import discord
+from discord.ext import commands
+
+
+LOG_ENTRY_HEADER = re.compile(r'^(.*) \((\d+)\) at (\d{4}-\d\d-\d\d \d\d:\d\d:\d\d) UTC$')
+LOG_SECTION_HEADER = re.compile(r'^(Embed description\(s\)|Attachment URL\(s\)|Archived attachment\(s\)):$')
+
+
+class TranscriptEntry(NamedTuple):
+    """One message in a modmail's log. Mirrors a row of the transcripts table (minus the modmail channel ID)."""
+
+    messageid: int
+    authorid: int
+    authorname: str
+    createdat: str
+    replyto: int  # ID of the message this one replies to, or None
+    content: str
+    embeds: list  # embed descriptions
+    attachments: list  # attachment URLs
+
+
+class Transcripts:
+    """Modmail logs, built up as the modmail happens instead of being read back from the channel when it's closed.
+
+    Every relayed message, opening notice and reason change is appended to the transcripts table when it's sent,
+    so closing a modmail doesn't need to page through the channel's history. Messages that couldn't be relayed, and
+    messages in the modmail channel that aren't relayed (commands, other bots), are recorded too.
+    """
+
+    undelivered_marker = '[not delivered] '
+
+
+    def __init__(self, bot: commands.Bot):
+        self.bot = bot
+
+    async def append(self, modmailchnlid: int, message: discord.Message, content: str = None, embeds: list = None, replyto: int = None):
+        """Add a message to a modmail's transcript.
+
+        :param modmailchnlid: Channel ID of the modmail.
+        :param message: The message to log. Its author, timestamp, ID and attachments are recorded.
+        :param content: Text to log instead of message.content (e.g. the untrimmed original of a relayed message).
+        :param embeds: Embeds to log instead of message.embeds.
+        :param replyto: ID of the logged message this one replies to, if any.
+        """
+
+        if content is None:
+            content = message.system_content
+        if embeds is None:
+            embeds = message.embeds
+
+        embed_descriptions = [embed.description for embed in embeds if embed.description]
+        attachment_urls = [attachment.url for attachment in message.attachments]
+
+        await self.bot.storage.add_transcript_entry(modmailchnlid, message.id, message.author.id, f'{message.author.name}#{message.author.discriminator}', str(message.created_at)[:19],
+                                                    replyto, content, json.dumps(embed_descriptions), json.dumps(attachment_urls))
+
+    async def start(self, modmailchnlid: int, message: discord.Message):
+        """Add a modmail's opening message to its transcript, and record that the transcript is complete from there."""
+
+        await self.append(modmailchnlid, message)
+        await self.bot.storage.add_transcript_start(modmailchnlid, message.id)
+
+    async def append_undelivered(self, modmailchnlid: int, message: discord.Message):
+        """Add a message that couldn't be relayed to a modmail's transcript, marked as not delivered."""
+        await self.append(modmailchnlid, message, content=f'{self.undelivered_marker}{message.system_content}')
+
+    async def is_complete(self, modmailchnlid: int, entries: list):
+        """Whether a transcript was recorded from the modmail's opening, so that the channel's history has nothing to add.
+
+        :param entries: The modmail's transcript, from entries().
+        """
+
+        start = await self.bot.storage.get_transcript_start(modmailchnlid)
+        return start is not None and bool(entries) and entries[0].messageid == start
+
+    async def log_files(self, modmailchnlid: int, modmail_channel: discord.TextChannel, filename: str, size_limit: int):
+        """Gather a modmail's whole log and write it out, as closemodmail sends it.
+
+        Whatever the transcript doesn't cover (see is_complete) is read from modmail_channel's history, unless the
+        channel is None (i.e. gone). Formatting is done in a worker thread, so a long log doesn't hold up relays.
+
+        :return: List of discord.File objects, in order (see write_log).
+        """
+
+        await self.bot.storage.flush()  # the last transcript entries may still be waiting to be committed
+        entries = await self.entries(modmailchnlid)
+        # a modmail that predates transcripts (or was re-registered by hand) was only recorded from its first relay since then,
+        # so whatever came before that is read from the channel; modmails recorded from their opening skip the history fetch
+        if modmail_channel is not None and not await self.is_complete(modmailchnlid, entries):
+            earlier_entries = await self.entries_from_history(modmail_channel, before=entries[0].messageid if entries else None)
+            entries = earlier_entries + entries
+
+        archived_attachments = await self.bot.attachment_archive.archived_for_modmail(modmailchnlid)
+
+        return await asyncio.to_thread(
+            self.write_log, entries, archived_attachments, filename, size_limit, compress=self.bot.server_vars.get('compress_modmail_logs', False))
+
+    async def entries(self, modmailchnlid: int):
+        """Return a modmail's transcript as a list of TranscriptEntry objects, oldest first."""
+
+        rows = await self.bot.storage.get_transcript(modmailchnlid)
+
+        return [TranscriptEntry(*row[:6], json.loads(row[6]), json.loads(row[7])) for row in rows]
+
+    async def entries_from_history(self, modmail_channel: discord.TextChannel, before: int = None):
+        """Build a transcript by reading a modmail channel's history.
+
+        Only needed for the part of a modmail from before its transcript was recorded: modmails opened before transcripts
+        existed, or re-registered by hand, only have a transcript from their first relay since then.
+
+        :param before: Only read messages older than this message ID (the first recorded one), or None for the whole history.
+        """
+
+        entries = []
+        before = discord.Object(before) if before is not None else None
+        async for message in modmail_channel.history(limit=None, before=before, oldest_first=True):
+            replyto = message.reference.resolved.id if message.reference and message.reference.resolved else None
+            entries.append(TranscriptEntry(message.id, message.author.id, f'{message.author.name}#{message.author.discriminator}', str(message.created_at)[:19],
+                                           replyto, message.system_content, [embed.description for embed in message.embeds if embed.description],
+                                           [attachment.url for attachment in message.attachments]))
+        return entries
+
+    async def forget(self, modmailchnlid: int):
+        await self.bot.storage.remove_transcript(modmailchnlid)
+
+    def format_entry(self, entry: TranscriptEntry, archived_attachments: dict):
+        """Format one transcript entry the way it appears in a modmail log.
+
+        :param entry: The TranscriptEntry to format.
+        :param archived_attachments: Dict of message ID -> list of (filename, archive path), from AttachmentArchive.
+        """
+
+        reply_if_any = f'Reply to: {entry.replyto}' if entry.replyto else ''
+
+        embeds_if_any = ''
+        if entry.embeds:
+            embed_desc_list = [fill(description) for description in entry.embeds]
+            embeds_if_any = '\nEmbed description(s):\n{}\n'.format(
+                ',\n\n'.join(embed_desc_list))
+
+        attachments_if_any = ''
+        if entry.attachments:
+            attachments_if_any = '\nAttachment URL(s):\n{}\n'.format(
+                ',\n'.join(entry.attachments))
+
+        archived_if_any = archived_attachments.get(entry.messageid)
+        if archived_if_any:
+            attachments_if_any += '\nArchived attachment(s):\n{}\n'.format(
+                ',\n'.join(f'{filename}: {archive_path}' for filename, archive_path in archived_if_any))
+
+        contentstr = f'Content:\n{fill(entry.content)}\n' if entry.content else '[no message content]\n'
+
+        return f'{entry.authorname} ({entry.authorid}) at {entry.createdat} UTC\n{reply_if_any}\n{contentstr}{embeds_if_any}{attachments_if_any}\n{entry.messageid}\n\n'
+
+    def write_log(self, entries: list, archived_attachments: dict, filename: str, size_limit: int, compress: bool = False, spill_bytes: int = 1024 * 1024):
+        """Write a transcript out as one or more modmail log files.
+
+        Blocking (formatting a long transcript is CPU-heavy), so call it from a worker thread.
+
+        :param entries: TranscriptEntry objects, oldest first.
+        :param archived_attachments: Dict of message ID -> list of (filename, archive path), from AttachmentArchive.
+        :param filename: Name of the log file. Later parts are suffixed with their part number.
+        :param size_limit: Maximum size of each file, in bytes (the upload limit of where the log is sent).
+        :param compress: Whether to gzip the log.
+        :param spill_bytes: Size past which each file is spilled from memory to a temporary file on disk.
+        :return: List of discord.File objects, in order.
+        """
+
+        log_writer = LogWriter(filename, size_limit, compress, spill_bytes)
+        for entry in entries:
+            log_writer.write(self.format_entry(entry, archived_attachments))
+        return log_writer.finish()
+
+
+class LogWriter:
+    """Streams a modmail log into as many files as it takes to keep each one within the upload limit.
+
+    Each file is kept in memory until it grows past spill_bytes, then moved to a temporary file on disk,
+    and can optionally be gzipped as it is written.
+    """
+
+    # room left in each file for compressed data that gzip is still holding in its buffers
+    gzip_margin = 64 * 1024
+
+    def __init__(self, filename: str, size_limit: int, compress: bool = False, spill_bytes: int = 1024 * 1024):
+        self.filename = filename
+        self.size_limit = size_limit
+        self.compress = compress
+        self.spill_bytes = spill_bytes
+
+        self._parts = []  # underlying (possibly compressed) file of each part
+        self._part = None
+        self._writer = None  # what text is written to: the part itself, or a GzipFile around it
+        self._part_has_text = False
+
+    def _start_part(self):
+        self._finish_part()
+        self._part = SpooledTemporaryFile(max_size=self.spill_bytes)
+        self._writer = GzipFile(fileobj=self._part, mode='wb') if self.compress else self._part
+        self._part_has_text = False
+        self._parts.append(self._part)
+
+    def _finish_part(self):
+        if self._writer is not None and self._writer is not self._part:
+            self._writer.close()  # flushes the gzip trailer; leaves the part itself open
+        self._writer = None
+
+    def write(self, text: str):
+        data = text.encode('utf-8')
+        margin = self.gzip_margin if self.compress else 0
+
+        if self._writer is None or (self._part_has_text and self._part.tell() + len(data) + margin > self.size_limit):
+            self._start_part()
+
+        self._writer.write(data)
+        self._part_has_text = True
+
+    def finish(self):
+        """Close the log and return it as a list of discord.File objects."""
+
+        if not self._parts:  # an empty log is still sent as one (empty) file
+            self._start_part()
+        self._finish_part()
+
+        extension = '.gz' if self.compress else ''
+        stem, dot, suffix = self.filename.rpartition('.')
+        if not dot:
+            stem, suffix = self.filename, ''
+
+        files = []
+        for part_number, part in enumerate(self._parts, start=1):
+            part.seek(0)
+            part_name = self.filename if len(self._parts) == 1 else f'{stem}-part{part_number}{dot}{suffix}'
+            files.append(discord.File(fp=part, filename=f'{part_name}{extension}'))
+        return files
+
+
+def parse_log(text: str):
+    """Read a modmail log (as written by Transcripts.write_log) back into a list of TranscriptEntry objects.
+
+    Lossy where the log is: content and embed descriptions come back wrapped the way the log wrapped them,
+    and archived attachment paths are dropped.
+    """
+
+    lines = text.split('\n')
+    # an entry starts with its header line, right after the previous entry's message ID and a blank line
+    starts = [index for index, line in enumerate(lines)
+              if LOG_ENTRY_HEADER.match(line) and (index == 0 or (index >= 2 and lines[index - 1] == '' and lines[index - 2].isdigit()))]
+
+    entries = []
+    for start, end in zip(starts, starts[1:] + [len(lines)]):
+        block = lines[start:end]
+        while block and block[-1] == '':
+            block.pop()
+
+        authorname, authorid, createdat = LOG_ENTRY_HEADER.match(block[0]).groups()
+        replyto = int(block[1][len('Reply to: '):]) if block[1].startswith('Reply to: ') else None
+
+        sections = {'Content': []}
+        current_section = sections['Content']
+        for line in block[2:-1]:
+            section_header = LOG_SECTION_HEADER.match(line)
+            if section_header:
+                current_section = sections[section_header.group(1)] = []
+            else:
+                current_section.append(line)
+
+        content_lines = sections['Content']
+        content = '\n'.join(content_lines[1:]).strip('\n') if content_lines[:1] == ['Content:'] else ''
+        embeds_str = '\n'.join(sections.get('Embed description(s)', [])).strip('\n')
+        embeds = embeds_str.split(',\n\n') if embeds_str else []
+        attachments = [line.rstrip(',') for line in sections.get('Attachment URL(s)', []) if line]
+
+        entries.append(TranscriptEntry(int(block[-1]), int(authorid), authorname, createdat, replyto, content, embeds, attachments))
+    return entries